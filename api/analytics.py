@@ -0,0 +1,206 @@
+import threading
+import time
+
+from django.conf import settings
+import numpy as np
+
+from .models import BaseGraph, Edge, Vertex
+
+
+def count(values, size):
+    """Returns how many times each number below ``size`` is in ``values``."""
+    return np.bincount(values, minlength=max(size, 1))[:size]
+
+
+def csr(size, sources, destinations):
+    """Returns the ``indptr`` and ``indices`` arrays of the CSR matrix with an
+    entry for each ``sources[k]``, ``destinations[k]`` pair."""
+    order = np.argsort(sources, kind='mergesort')
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(count(sources, size), out=indptr[1:])
+    return indptr, destinations[order]
+
+
+def gather(indptr, indices, rows):
+    """Returns the concatenated columns of ``rows``, without a Python loop."""
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    total = int(counts.sum())
+    if not total:
+        return indices[:0]
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return indices[offsets + np.arange(total)]
+
+
+class AdjacencyIndex(object):
+    """Compact, read-only copy of the ``Microdot``/``Depends`` graph.
+
+    Vertices are numbered by ``ids`` and ``names`` maps the numbers back. The
+    dependencies of vertex ``i`` are ``indices[indptr[i]:indptr[i + 1]]`` and
+    its dependents ``rindices[rindptr[i]:rindptr[i + 1]]``.
+    """
+
+    def __init__(self, names, origins, targets):
+        self.names = list(names)
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        self.size = len(self.names)
+        origins = np.asarray(origins, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        self.indptr, self.indices = csr(self.size, origins, targets)
+        self.rindptr, self.rindices = csr(self.size, targets, origins)
+
+    @classmethod
+    def from_rows(cls, vertex_rows, edge_rows):
+        """Builds the index from ``GraphStore.vertex_rows`` and ``edge_rows``."""
+        names = [r['name'] for r in vertex_rows]
+        ids = {name: i for i, name in enumerate(names)}
+        for r in edge_rows:
+            for name in (r['origin'], r['target']):
+                if name not in ids:
+                    ids[name] = len(names)
+                    names.append(name)
+        return cls(names,
+                   [ids[r['origin']] for r in edge_rows],
+                   [ids[r['target']] for r in edge_rows])
+
+    def out_degree(self):
+        return np.diff(self.indptr)
+
+    def in_degree(self):
+        return np.diff(self.rindptr)
+
+    def dependents(self):
+        """Returns the ``dependents_number`` of every vertex by name."""
+        return dict(zip(self.names, self.in_degree().tolist()))
+
+    def reachable(self, name, reverse=True):
+        """Returns the number of hops to every vertex reachable from ``name``,
+        following dependents, or dependencies if not ``reverse``."""
+        indptr, indices = (self.rindptr, self.rindices) if reverse else (self.indptr, self.indices)
+        distance = np.full(self.size, -1, dtype=np.int64)
+        frontier = np.array([self.ids[name]], dtype=np.int64)
+        distance[frontier] = 0
+        hops = 0
+        while frontier.size:
+            hops += 1
+            reached = np.unique(gather(indptr, indices, frontier))
+            frontier = reached[distance[reached] < 0]
+            distance[frontier] = hops
+        found = np.flatnonzero(distance > 0)
+        return {self.names[i]: int(distance[i]) for i in found}
+
+    def levels(self):
+        """Returns the length of the longest dependency chain leading to each
+        vertex from one without dependents, peeling the graph a level at a
+        time. Vertices in or depending on cycles are left at -1."""
+        remaining = self.in_degree().copy()
+        level = np.full(self.size, -1, dtype=np.int64)
+        frontier = np.flatnonzero(remaining == 0)
+        depth = 0
+        while frontier.size:
+            level[frontier] = depth
+            remaining -= count(gather(self.indptr, self.indices, frontier), self.size)
+            frontier = np.flatnonzero((remaining == 0) & (level < 0))
+            depth += 1
+        return level
+
+    def longest_chain(self, level=None):
+        """Returns the names along one of the longest dependency chains."""
+        level = self.levels() if level is None else level
+        if not self.size or level.max() < 0:
+            return []
+        current = int(level.argmax())
+        chain = [current]
+        while level[current] > 0:
+            dependents = self.rindices[self.rindptr[current]:self.rindptr[current + 1]]
+            current = int(dependents[level[dependents] == level[current] - 1][0])
+            chain.append(current)
+        return [self.names[i] for i in reversed(chain)]
+
+    def components(self):
+        """Returns the strongly connected components, as lists of vertex
+        numbers, with an iterative Tarjan's algorithm."""
+        indptr = self.indptr.tolist()
+        indices = self.indices.tolist()
+        index = [-1] * self.size
+        low = [0] * self.size
+        on_stack = [False] * self.size
+        stack = []
+        components = []
+        counter = 0
+        for root in range(self.size):
+            if index[root] >= 0:
+                continue
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = True
+            work = [(root, indptr[root])]
+            while work:
+                v, i = work[-1]
+                if i < indptr[v + 1]:
+                    work[-1] = (v, i + 1)
+                    w = indices[i]
+                    if index[w] < 0:
+                        index[w] = low[w] = counter
+                        counter += 1
+                        stack.append(w)
+                        on_stack[w] = True
+                        work.append((w, indptr[w]))
+                    elif on_stack[w]:
+                        low[v] = min(low[v], index[w])
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[v])
+                if low[v] == index[v]:
+                    component = []
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = False
+                        component.append(w)
+                        if w == v:
+                            break
+                    components.append(component)
+        return components
+
+    def cycles(self):
+        """Returns the names of the vertices of each dependency cycle."""
+        cycles = []
+        for component in self.components():
+            v = component[0]
+            if len(component) > 1 or v in self.indices[self.indptr[v]:self.indptr[v + 1]]:
+                cycles.append(sorted(self.names[i] for i in component))
+        return sorted(cycles)
+
+
+class AnalyticsIndex(BaseGraph):
+    """Keeps the ``AdjacencyIndex`` of this process. It is rebuilt, with two
+    bulk queries, once it is ``ANALYTICS_INDEX_TTL`` seconds old and the graph
+    version changed."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def get(self):
+        version = self.backend.graph_version()
+        with self.lock:
+            stale = (version != self.version and
+                     time.time() - self.built >= settings.ANALYTICS_INDEX_TTL)
+            if self.index is None or stale:
+                self.index = AdjacencyIndex.from_rows(
+                    self.graph.vertex_rows(Vertex.LABEL, Edge.TYPE),
+                    self.graph.edge_rows(Vertex.LABEL, Edge.TYPE))
+                self.version = version
+                self.built = time.time()
+            return self.index
+
+    def clear(self):
+        self.index = None
+        self.version = None
+        self.built = 0
+
+
+analytics_index = AnalyticsIndex()
@@ -1,27 +1,629 @@
+from collections import Counter, defaultdict, deque
+import itertools
+import json
 import random
+import re
 import string
+import threading
+import time
 from django.conf import settings
 import redis
 
+from .connections import ProcessLocal
+from .sketches import LatencySketch
+
 
 class RedisBackend(object):
+    """Stores every endpoint hit as its own key, expiring after
+    ``ENDPOINT_ENTRY_TIMEOUT`` seconds."""
+
+    MGET_CHUNK_SIZE = 1000
+    GRAPH_VERSION_KEY = 'microdots:graph-version'
+    CHANGELOG_KEY = 'microdots:graph-changes'
+    CHANGED_EDGES_KEY = 'microdots:changed-edges:{bucket}'
+    QUEUE_KEY = 'microdots:queue'
+    PROCESSING_KEY = 'microdots:processing:{worker}'
+    DEAD_LETTER_KEY = 'microdots:dead-letter'
+    WORKERS_KEY = 'microdots:workers'
+    WORKER_LEASE_KEY = 'microdots:worker:{worker}'
+
     def __init__(self):
-        self.redis_server = redis.from_url(settings.REDIS_URL)
+        self.connection = ProcessLocal(self.connect)
+        self.client_wrapper = None
+
+    @property
+    def redis_server(self):
+        return self.connection.get()
+
+    def connect(self):
+        pool = redis.BlockingConnectionPool.from_url(
+            settings.REDIS_URL,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            socket_keepalive=True,
+        )
+        client = redis.Redis(connection_pool=pool)
+        if self.client_wrapper is not None:
+            client = self.client_wrapper(client)
+        return client
 
     def flush_db(self):
         self.redis_server.flushdb()
 
+    def graph_version(self):
+        return int(self.redis_server.get(self.GRAPH_VERSION_KEY) or 0)
+
+    def bump_graph_version(self, changes=()):
+        """Increments the graph version, logging the ``changes`` made by this
+        version in the same transaction, so the log holds one entry per
+        version, newest first."""
+        pipeline = self.redis_server.pipeline()
+        pipeline.incr(self.GRAPH_VERSION_KEY)
+        pipeline.lpush(self.CHANGELOG_KEY, json.dumps(list(changes)))
+        pipeline.ltrim(self.CHANGELOG_KEY, 0, settings.GRAPH_CHANGELOG_SIZE - 1)
+        return pipeline.execute()[0]
+
+    def load_graph_changes(self, since):
+        """Returns the graph version and the changes logged after version
+        ``since``, oldest first, or None instead of the changes when some of
+        them are no longer logged."""
+        version = self.graph_version()
+        while 0 <= since < version:
+            pipeline = self.redis_server.pipeline()
+            pipeline.get(self.GRAPH_VERSION_KEY)
+            pipeline.lrange(self.CHANGELOG_KEY, 0, version - since - 1)
+            current, entries = pipeline.execute()
+            if int(current) == version:
+                if len(entries) < version - since:
+                    return version, None
+                return version, [change for entry in reversed(entries)
+                                 for change in json.loads(entry.decode('utf-8'))]
+            version = int(current)
+        return version, [] if since == version else None
+
+    def mark_changed_edges(self, pipeline, edges):
+        """Adds the ``(origin, target)`` pairs of ``edges`` to the edges whose
+        counters changed in the current bucket."""
+        if not edges:
+            return
+        bucket = current_bucket()
+        key = self.CHANGED_EDGES_KEY.format(bucket=bucket)
+        pipeline.sadd(key, *[json.dumps(list(edge)) for edge in edges])
+        pipeline.expireat(key, changes_expiry(bucket))
+
+    def load_changed_edges(self, buckets):
+        """Returns the pairs of the edges whose counters changed in ``buckets``."""
+        keys = [self.CHANGED_EDGES_KEY.format(bucket=bucket) for bucket in buckets]
+        if not keys:
+            return set()
+        return {tuple(json.loads(member.decode('utf-8')))
+                for member in self.redis_server.sunion(keys)}
+
+    def enqueue_microdots(self, hits, latencies=None):
+        """Queues ``hits``, a mapping of ``(origin, target, endpoint)`` to a
+        count, and their ``latencies`` sketches, for ``run_microdot_worker``."""
+        events = [json.dumps(event) for event in microdot_events(hits, latencies)]
+        if events:
+            self.redis_server.lpush(self.QUEUE_KEY, *events)
+
+    def dequeue_microdots(self, worker, batch_size, timeout):
+        """Moves up to ``batch_size`` queued events to the processing list of
+        ``worker``, waiting up to ``timeout`` seconds for the first one.
+
+        Events stay in the processing list until ``ack_microdots`` is called,
+        so ``recover_microdots`` can queue them again if the worker dies. Each
+        call renews the lease of ``worker`` for ``MICRODOT_WORKER_LEASE``
+        seconds, after which ``recover_abandoned_microdots`` takes them back.
+        """
+        processing = self.PROCESSING_KEY.format(worker=worker)
+        pipeline = self.redis_server.pipeline(transaction=False)
+        pipeline.sadd(self.WORKERS_KEY, worker)
+        pipeline.set(self.WORKER_LEASE_KEY.format(worker=worker), 1,
+                     ex=settings.MICRODOT_WORKER_LEASE)
+        pipeline.execute()
+        first = self.redis_server.brpoplpush(self.QUEUE_KEY, processing, timeout)
+        if first is None:
+            return []
+
+        pipeline = self.redis_server.pipeline(transaction=False)
+        for _ in range(batch_size - 1):
+            pipeline.rpoplpush(self.QUEUE_KEY, processing)
+        events = [first] + [e for e in pipeline.execute() if e is not None]
+        return [json.loads(e.decode('utf-8')) for e in events]
+
+    def ack_microdots(self, worker):
+        self.redis_server.delete(self.PROCESSING_KEY.format(worker=worker))
+
+    def recover_microdots(self, worker):
+        """Queues again the events left unacknowledged by ``worker``."""
+        processing = self.PROCESSING_KEY.format(worker=worker)
+        recovered = 0
+        while self.redis_server.rpoplpush(processing, self.QUEUE_KEY) is not None:
+            recovered += 1
+        return recovered
+
+    def recover_abandoned_microdots(self):
+        """Queues again the events left unacknowledged by the workers whose
+        lease expired, and returns their number."""
+        recovered = 0
+        for worker in self.redis_server.smembers(self.WORKERS_KEY):
+            worker = worker.decode('utf-8')
+            if not self.redis_server.exists(self.WORKER_LEASE_KEY.format(worker=worker)):
+                self.redis_server.srem(self.WORKERS_KEY, worker)
+                recovered += self.recover_microdots(worker)
+        return recovered
+
+    def retry_microdots(self, worker, max_attempts):
+        """Queues again the events ``worker`` failed to store, moving those
+        which failed ``max_attempts`` times to the dead-letter list instead.
+        Returns the numbers of events queued again and dead-lettered."""
+        processing = self.PROCESSING_KEY.format(worker=worker)
+        retried, dead = [], []
+        for event in reversed(self.redis_server.lrange(processing, 0, -1)):
+            event = json.loads(event.decode('utf-8'))
+            event['attempts'] = event.get('attempts', 0) + 1
+            (dead if event['attempts'] >= max_attempts else retried).append(json.dumps(event))
+        pipeline = self.redis_server.pipeline()
+        if retried:
+            pipeline.lpush(self.QUEUE_KEY, *retried)
+        if dead:
+            pipeline.lpush(self.DEAD_LETTER_KEY, *dead)
+        pipeline.delete(processing)
+        pipeline.execute()
+        return len(retried), len(dead)
+
+    def queue_stats(self):
+        """Returns the queue depth, the age in seconds of its oldest event and
+        the number of dead-lettered events."""
+        pipeline = self.redis_server.pipeline(transaction=False)
+        pipeline.llen(self.QUEUE_KEY)
+        pipeline.lindex(self.QUEUE_KEY, -1)
+        pipeline.llen(self.DEAD_LETTER_KEY)
+        depth, oldest, dead = pipeline.execute()
+        lag = 0
+        if oldest is not None:
+            lag = max(0, time.time() - json.loads(oldest.decode('utf-8'))['time'])
+        return {'depth': depth, 'lag': lag, 'dead_letter': dead}
+
     def load_endpoints(self, prefix):
-        endpoints = []
-        for k in self.redis_server.keys(prefix + '*'):
-            v = self.redis_server.get(k)
-            endpoints.append(v.decode('utf-8'))
-        return endpoints
+        return self.load_endpoints_many([prefix])[prefix]
+
+    def load_endpoints_many(self, names):
+        """Loads the endpoint counters of every edge in ``names`` by scanning
+        the per-hit keys of each one, returning a ``Counter`` by name."""
+        names = set(names)
+        keys = itertools.chain.from_iterable(
+            self.redis_server.scan_iter(match=escape_pattern(name) + '#*') for name in names)
+        return self.count_keys(names, keys)
+
+    def count_keys(self, names, keys):
+        counters = {name: Counter() for name in names}
+        batch = []
+        for key in keys:
+            name = key.decode('utf-8').rsplit('#', 1)[0]
+            if name in counters:
+                batch.append((name, key))
+        for start in range(0, len(batch), self.MGET_CHUNK_SIZE):
+            chunk = batch[start:start + self.MGET_CHUNK_SIZE]
+            values = self.redis_server.mget([key for _, key in chunk])
+            for (name, _), value in zip(chunk, values):
+                if value is not None:
+                    counters[name][value.decode('utf-8')] += 1
+        return counters
 
     def save_endpoint(self, name, endpoint):
+        self.save_endpoints({(name, endpoint): 1})
+
+    def save_endpoints(self, hits, latencies=None, edges=None):
+        """Stores every hit of ``hits``, a mapping of ``(name, endpoint)`` to a
+        count, and the ``latencies`` sketches of the same keys, using a single
+        pipeline. The ``(origin, target)`` pairs of the hit ``edges`` are
+        marked as changed for ``GET /graph/changes/``."""
+        pipeline = self.redis_server.pipeline(transaction=False)
+        for (name, endpoint), count in hits.items():
+            for _ in range(count):
+                pipeline.set(self.endpoint_key(name), endpoint,
+                             ex=settings.ENDPOINT_ENTRY_TIMEOUT)
+        self.add_rollups(pipeline, hits)
+        self.mark_changed_edges(pipeline, edges)
+        if latencies:
+            self.add_latencies(pipeline, latencies)
+        pipeline.execute()
+
+    def add_rollups(self, pipeline, hits):
+        """Adds ``hits`` to the current bucket of every tier in
+        ``ROLLUP_TIERS``, expiring each bucket after the tier's retention."""
+        now = time.time()
+        for tier, step, retention in settings.ROLLUP_TIERS:
+            bucket = int(now // step)
+            keys = set()
+            for (name, endpoint), count in hits.items():
+                key = self.rollup_key(name, tier, bucket)
+                pipeline.hincrby(key, endpoint, count)
+                keys.add(key)
+            for key in keys:
+                pipeline.expireat(key, (bucket + 1) * step + retention)
+
+    def add_latencies(self, pipeline, latencies):
+        """Merges ``latencies`` into the sketches of the current bucket, one
+        hash per edge holding the counters of every endpoint, expiring with
+        the bucketed endpoint counters."""
+        bucket = current_bucket()
+        keys = set()
+        for (name, endpoint), sketch in latencies.items():
+            key = self.latency_key(name, bucket)
+            for field, count in sketch.to_fields().items():
+                pipeline.hincrby(key, '{}|{}'.format(endpoint, field), count)
+            keys.add(key)
+        for key in keys:
+            pipeline.expireat(key, bucket_expiry(bucket))
+
+    def latency_key(self, name, bucket):
+        return '{name}:latency:{bucket}'.format(name=name, bucket=bucket)
+
+    def load_latencies_many(self, names):
+        """Loads the latency sketches of the live window of every edge in
+        ``names`` in a single pipeline, returning them by name and endpoint."""
+        names = list(names)
+        buckets = window_buckets()
+        pipeline = self.redis_server.pipeline(transaction=False)
+        for name in names:
+            for bucket in buckets:
+                pipeline.hgetall(self.latency_key(name, bucket))
+        results = iter(pipeline.execute())
+
+        sketches = {}
+        for name in names:
+            endpoints = sketches.setdefault(name, {})
+            for _ in buckets:
+                for field, count in next(results).items():
+                    endpoint, field = field.decode('utf-8').rsplit('|', 1)
+                    endpoints.setdefault(endpoint, LatencySketch()).add_field(field, int(count))
+        return sketches
+
+    def rollup_key(self, name, tier, bucket):
+        return '{name}@{tier}:{bucket}'.format(name=name, tier=tier, bucket=bucket)
+
+    def load_rollups_many(self, names, seconds):
+        """Loads the endpoint counters of the last ``seconds`` of every edge in
+        ``names``, from the coarsest rollup tier covering them."""
+        tier, buckets = rollup_buckets(seconds)
+        return self.load_hashes(names, lambda name, bucket: self.rollup_key(name, tier, bucket),
+                                buckets)
+
+    def load_hashes(self, names, key, buckets):
+        """Sums the counters held by the hashes of every name and bucket in a
+        single pipeline, returning a ``Counter`` by name."""
+        names = list(names)
+        pipeline = self.redis_server.pipeline(transaction=False)
+        for name in names:
+            for bucket in buckets:
+                pipeline.hgetall(key(name, bucket))
+        results = iter(pipeline.execute())
+
+        counters = {}
+        for name in names:
+            endpoints = counters.setdefault(name, Counter())
+            for _ in buckets:
+                for endpoint, count in next(results).items():
+                    endpoints[endpoint.decode('utf-8')] += int(count)
+        return counters
+
+    def endpoint_key(self, name):
         random_suffix = ''.join(
             [random.choice(string.digits + string.ascii_letters) for x in range(16)]
         )
-        id = '{name}#{suffix}'.format(name=name, suffix=random_suffix)
-        self.redis_server.set(id, endpoint)
-        self.redis_server.expire(id, settings.ENDPOINT_ENTRY_TIMEOUT)
+        return '{name}#{suffix}'.format(name=name, suffix=random_suffix)
+
+
+class BucketedRedisBackend(RedisBackend):
+    """Counts endpoint hits in one hash per edge and ``ENDPOINT_BUCKET_SIZE``
+    seconds, expiring whole buckets once they leave the
+    ``ENDPOINT_ENTRY_TIMEOUT`` window.
+
+    With ``legacy_reads`` the per-hit keys written by ``RedisBackend`` are
+    counted as well, so the layout can be switched without losing the hits
+    that are still inside the window.
+    """
+
+    def __init__(self, legacy_reads=False):
+        super().__init__()
+        self.legacy_reads = legacy_reads
+
+    def bucket_key(self, name, bucket):
+        return '{name}:{bucket}'.format(name=name, bucket=bucket)
+
+    def load_endpoints(self, prefix):
+        return self.load_endpoints_many([prefix])[prefix]
+
+    def load_endpoints_many(self, names):
+        names = list(names)
+        counters = self.load_hashes(names, self.bucket_key, window_buckets())
+        if self.legacy_reads:
+            for name, endpoints in super().load_endpoints_many(names).items():
+                counters[name].update(endpoints)
+        return counters
+
+    def save_endpoints(self, hits, latencies=None, edges=None):
+        bucket = current_bucket()
+        expire_at = bucket_expiry(bucket)
+        keys = set()
+
+        pipeline = self.redis_server.pipeline(transaction=False)
+        for (name, endpoint), count in hits.items():
+            key = self.bucket_key(name, bucket)
+            pipeline.hincrby(key, endpoint, count)
+            keys.add(key)
+        for key in keys:
+            pipeline.expireat(key, expire_at)
+        self.add_rollups(pipeline, hits)
+        self.mark_changed_edges(pipeline, edges)
+        if latencies:
+            self.add_latencies(pipeline, latencies)
+        pipeline.execute()
+
+
+class MemoryBackend(object):
+    """Keeps endpoint counters, the graph version and its changes, and the
+    microdot queue in process memory, for tests and benchmarks.
+
+    Counters are bucketed like ``BucketedRedisBackend``'s, and buckets are
+    dropped once they leave the ``ENDPOINT_ENTRY_TIMEOUT`` window.
+    """
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.flush_db()
+
+    def flush_db(self):
+        with self.lock:
+            self.buckets = defaultdict(dict)
+            self.latencies = defaultdict(dict)
+            self.rollups = defaultdict(dict)
+            self.version = 0
+            self.changelog = deque()
+            self.changed_edges = defaultdict(set)
+            self.queue = deque()
+            self.processing = defaultdict(list)
+            self.dead_letter = deque()
+            self.leases = {}
+
+    def graph_version(self):
+        return self.version
+
+    def bump_graph_version(self, changes=()):
+        with self.lock:
+            self.version += 1
+            self.changelog.appendleft(list(changes))
+            while len(self.changelog) > settings.GRAPH_CHANGELOG_SIZE:
+                self.changelog.pop()
+            return self.version
+
+    def load_graph_changes(self, since):
+        with self.lock:
+            count = self.version - since
+            if not 0 <= count <= len(self.changelog):
+                return self.version, None
+            entries = list(itertools.islice(self.changelog, count))
+            return self.version, [change for entry in reversed(entries) for change in entry]
+
+    def load_changed_edges(self, buckets):
+        with self.lock:
+            return set().union(*(self.changed_edges.get(bucket, ()) for bucket in buckets))
+
+    def enqueue_microdots(self, hits, latencies=None):
+        with self.lock:
+            self.queue.extendleft(microdot_events(hits, latencies))
+            self.lock.notify_all()
+
+    def dequeue_microdots(self, worker, batch_size, timeout):
+        with self.lock:
+            self.leases[worker] = time.time() + settings.MICRODOT_WORKER_LEASE
+            self.lock.wait_for(lambda: self.queue, timeout)
+            events = [self.queue.pop() for _ in range(min(batch_size, len(self.queue)))]
+            self.processing[worker].extend(events)
+            return events
+
+    def ack_microdots(self, worker):
+        with self.lock:
+            self.processing.pop(worker, None)
+
+    def recover_microdots(self, worker):
+        with self.lock:
+            events = self.processing.pop(worker, [])
+            self.queue.extend(reversed(events))
+            return len(events)
+
+    def recover_abandoned_microdots(self):
+        with self.lock:
+            now = time.time()
+            abandoned = [worker for worker, expiry in self.leases.items() if expiry <= now]
+            for worker in abandoned:
+                del self.leases[worker]
+            recovered = sum(self.recover_microdots(worker) for worker in abandoned)
+            self.lock.notify_all()
+            return recovered
+
+    def retry_microdots(self, worker, max_attempts):
+        with self.lock:
+            retried, dead = [], []
+            for event in self.processing.pop(worker, []):
+                event['attempts'] = event.get('attempts', 0) + 1
+                (dead if event['attempts'] >= max_attempts else retried).append(event)
+            self.queue.extendleft(retried)
+            self.dead_letter.extendleft(dead)
+            self.lock.notify_all()
+            return len(retried), len(dead)
+
+    def queue_stats(self):
+        with self.lock:
+            lag = max(0, time.time() - self.queue[-1]['time']) if self.queue else 0
+            return {'depth': len(self.queue), 'lag': lag, 'dead_letter': len(self.dead_letter)}
+
+    def load_endpoints(self, prefix):
+        return self.load_endpoints_many([prefix])[prefix]
+
+    def load_endpoints_many(self, names):
+        first = window_buckets()[0]
+        counters = {}
+        with self.lock:
+            for name in names:
+                endpoints = counters[name] = Counter()
+                for counts in self.expire(name, first).values():
+                    endpoints.update(counts)
+        return counters
+
+    def save_endpoint(self, name, endpoint):
+        self.save_endpoints({(name, endpoint): 1})
+
+    def save_endpoints(self, hits, latencies=None, edges=None):
+        bucket = current_bucket()
+        first = window_buckets()[0]
+        with self.lock:
+            if edges:
+                for expired in [b for b in self.changed_edges if changes_expiry(b) < time.time()]:
+                    del self.changed_edges[expired]
+                self.changed_edges[bucket].update(edges)
+            for (name, endpoint), count in hits.items():
+                self.expire(name, first)
+                self.buckets[name].setdefault(bucket, Counter())[endpoint] += count
+                self.add_rollups(name, endpoint, count)
+            for (name, endpoint), sketch in (latencies or {}).items():
+                self.expire(name, first, self.latencies)
+                sketches = self.latencies[name].setdefault(bucket, {})
+                sketches.setdefault(endpoint, LatencySketch()).merge(sketch)
+
+    def load_latencies_many(self, names):
+        first = window_buckets()[0]
+        sketches = {}
+        with self.lock:
+            for name in names:
+                endpoints = sketches[name] = {}
+                for bucket in self.expire(name, first, self.latencies).values():
+                    for endpoint, sketch in bucket.items():
+                        endpoints.setdefault(endpoint, LatencySketch()).merge(sketch)
+        return sketches
+
+    def add_rollups(self, name, endpoint, count):
+        now = time.time()
+        rollups = self.rollups[name]
+        for tier, step, retention in settings.ROLLUP_TIERS:
+            bucket = int(now // step)
+            if (tier, bucket) not in rollups:
+                expired = [k for k in rollups
+                           if k[0] == tier and (k[1] + 1) * step + retention < now]
+                for key in expired:
+                    del rollups[key]
+                rollups[tier, bucket] = Counter()
+            rollups[tier, bucket][endpoint] += count
+
+    def load_rollups_many(self, names, seconds):
+        tier, buckets = rollup_buckets(seconds)
+        counters = {}
+        with self.lock:
+            for name in names:
+                endpoints = counters[name] = Counter()
+                rollups = self.rollups.get(name, {})
+                for bucket in buckets:
+                    endpoints.update(rollups.get((tier, bucket), ()))
+        return counters
+
+    def expire(self, name, first, store=None):
+        """Drops the buckets of ``name`` older than ``first`` from ``store``,
+        the endpoint counters by default, returning the remaining ones."""
+        store = self.buckets if store is None else store
+        buckets = store.get(name, {})
+        for bucket in [b for b in buckets if b < first]:
+            del buckets[bucket]
+        return buckets
+
+
+def current_bucket():
+    return int(time.time() // settings.ENDPOINT_BUCKET_SIZE)
+
+
+def bucket_expiry(bucket):
+    """Time at which ``bucket`` leaves the ``ENDPOINT_ENTRY_TIMEOUT`` window."""
+    return (bucket + 1) * settings.ENDPOINT_BUCKET_SIZE + settings.ENDPOINT_ENTRY_TIMEOUT
+
+
+def changes_expiry(bucket):
+    """Time after which the edges changed in ``bucket`` no longer matter to
+    clients of ``GET /graph/changes/`` within ``GRAPH_CHANGES_RETENTION``."""
+    return (bucket_expiry(bucket) + settings.ENDPOINT_BUCKET_SIZE +
+            settings.GRAPH_CHANGES_RETENTION)
+
+
+def changed_buckets(since):
+    """Buckets of the edges whose counters may have changed since bucket
+    ``since``: those hit since, and those whose hits left the
+    ``ENDPOINT_ENTRY_TIMEOUT`` window since."""
+    now = time.time()
+    step, timeout = settings.ENDPOINT_BUCKET_SIZE, settings.ENDPOINT_ENTRY_TIMEOUT
+    first = since - int(timeout // step) - 1
+    return [bucket for bucket in range(first, int(now // step) + 1)
+            if bucket >= since or
+            since * step < (bucket + 1) * step + timeout and bucket * step + timeout < now]
+
+
+def microdot_events(hits, latencies=None):
+    """Returns the queue events of ``hits`` and their ``latencies``."""
+    now = time.time()
+    latencies = latencies or {}
+    events = []
+    for hit, count in hits.items():
+        origin, target, endpoint = hit
+        event = {'origin': origin, 'target': target, 'endpoint': endpoint,
+                 'count': count, 'time': now}
+        if hit in latencies:
+            event['latency'] = latencies[hit].to_fields()
+        events.append(event)
+    return events
+
+
+def window_buckets():
+    """Buckets which may still hold hits younger than ``ENDPOINT_ENTRY_TIMEOUT``."""
+    now = time.time()
+    first = int((now - settings.ENDPOINT_ENTRY_TIMEOUT) // settings.ENDPOINT_BUCKET_SIZE)
+    last = int(now // settings.ENDPOINT_BUCKET_SIZE)
+    return range(first, last + 1)
+
+
+def rollup_tier(seconds):
+    """Returns the coarsest tier of ``ROLLUP_TIERS`` keeping ``seconds`` of
+    hits in at least ``ROLLUP_MIN_BUCKETS`` buckets, or the finest one for
+    shorter windows."""
+    tiers = [t for t in settings.ROLLUP_TIERS if t[2] >= seconds]
+    if not tiers:
+        raise ValueError('No rollup tier keeps {} seconds of hits'.format(seconds))
+    fitting = [t for t in tiers if t[1] * settings.ROLLUP_MIN_BUCKETS <= seconds]
+    if fitting:
+        return max(fitting, key=lambda t: t[1])
+    return min(tiers, key=lambda t: t[1])
+
+
+def rollup_buckets(seconds):
+    """Returns the name of the tier serving the last ``seconds`` and its
+    buckets covering them, rounded out to whole buckets."""
+    tier, step, _ = rollup_tier(seconds)
+    now = time.time()
+    return tier, range(int((now - seconds) // step), int(now // step) + 1)
+
+
+def escape_pattern(value):
+    """Escapes the glob characters understood by ``SCAN MATCH``."""
+    return re.sub(r'([*?\[\]\\])', r'\\\1', value)
+
+
+def get_backend(name, layout):
+    if name == 'memory':
+        return MemoryBackend()
+    if name != 'redis':
+        raise ValueError('Unknown counter backend: {}'.format(name))
+    if layout == 'keys':
+        return RedisBackend()
+    if layout == 'buckets':
+        return BucketedRedisBackend()
+    if layout == 'migrate':
+        return BucketedRedisBackend(legacy_reads=True)
+    raise ValueError('Unknown endpoint storage layout: {}'.format(layout))
@@ -0,0 +1,226 @@
+from bisect import bisect
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import json
+import time
+import urllib.error
+import urllib.request
+
+from rest_framework.test import APIClient
+
+from .cache import graph_cache
+from .instrumentation import instrumented_backends, metrics
+
+METHODS = ('GET', 'GET', 'GET', 'POST', 'PUT', 'DELETE')
+
+
+def synthetic_topology(services, fan_out, endpoints, rng):
+    """Returns ``(origin, target, method, endpoint)`` calls between
+    ``services`` services, each calling ``fan_out`` others on ``endpoints`` of
+    their endpoints. Services with lower numbers are called more often."""
+    names = ['service-{}'.format(i) for i in range(services)]
+    service_endpoints = {
+        name: ['{} /{}/resource-{}/{}'.format(rng.choice(METHODS), name, i, rng.randint(1, 10 ** 6))
+               for i in range(endpoints)]
+        for name in names
+    }
+    weights = zipf_weights(services, 1.0)
+
+    calls = []
+    for origin in names:
+        targets = set()
+        while len(targets) < min(fan_out, services - 1):
+            target = names[weighted_index(weights, rng)]
+            if target != origin:
+                targets.add(target)
+        for target in sorted(targets):
+            for endpoint in service_endpoints[target]:
+                method, uri = endpoint.split(' ', 1)
+                calls.append((origin, target, method, uri))
+    return calls
+
+
+def zipf_weights(size, exponent):
+    return list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, size + 1)))
+
+
+def weighted_index(cumulative_weights, rng):
+    return bisect(cumulative_weights, rng.random() * cumulative_weights[-1])
+
+
+def zipf_events(calls, count, exponent, rng):
+    """Yields ``count`` microdots picking ``calls`` by a Zipf distribution of
+    ``exponent``, in a shuffled order of popularity."""
+    calls = list(calls)
+    rng.shuffle(calls)
+    weights = zipf_weights(len(calls), exponent)
+    for _ in range(count):
+        origin, target, method, endpoint = calls[weighted_index(weights, rng)]
+        yield {'origin': origin, 'target': target, 'method': method, 'endpoint': endpoint}
+
+
+def replay_events(path):
+    """Yields the microdots of a JSON lines file, one object per line."""
+    with open(path) as lines:
+        for line in lines:
+            if line.strip():
+                event = json.loads(line)
+                yield {key: event[key] for key in ('origin', 'target', 'method', 'endpoint')}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class Operation(object):
+    """Latencies and backend calls recorded for one kind of request."""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.calls = Counter()
+        self.elapsed = 0
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        requests = len(latencies)
+        store_calls = sum(count for key, count in self.calls.items()
+                          if key.split('.', 1)[0] in ('graph', 'counters'))
+        return {
+            'requests': requests,
+            'throughput': requests / self.elapsed if self.elapsed else None,
+            'latency_ms': {
+                'p50': percentile(latencies, 0.5),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99),
+                'max': latencies[-1] if latencies else None,
+            },
+            'backend_calls': {
+                'total': store_calls,
+                'per_request': store_calls / requests if requests else None,
+                'by_operation': dict(sorted(self.calls.items())),
+            },
+        }
+
+
+class Benchmark(object):
+    """Drives ``POST /microdot/`` (or ``/microdot/batch/``) and ``GET /graph/``
+    through the test client, timing every request and counting the backend
+    calls it makes."""
+
+    def __init__(self, batch_size=None, cached=False):
+        self.client = APIClient()
+        self.batch_size = batch_size
+        self.cached = cached
+        self.ingest = Operation('ingest')
+        self.render = Operation('graph')
+
+    def timed(self, operation, request):
+        with metrics.track_calls() as calls:
+            start = time.perf_counter()
+            response = request()
+            elapsed = time.perf_counter() - start
+        operation.elapsed += elapsed
+        operation.latencies.append(elapsed * 1000)
+        operation.calls.update(calls)
+        if response.status_code >= 400:
+            raise RuntimeError('{} failed with {}: {}'.format(
+                operation.name, response.status_code, response.content))
+        return response
+
+    def run_ingest(self, events):
+        with instrumented_backends():
+            if not self.batch_size:
+                for event in events:
+                    self.timed(self.ingest, lambda: self.client.post('/microdot/', event))
+                return
+            events = iter(events)
+            while True:
+                batch = list(itertools.islice(events, self.batch_size))
+                if not batch:
+                    break
+                self.timed(self.ingest, lambda: self.client.post('/microdot/batch/', batch,
+                                                                 format='json'))
+
+    def run_render(self, renders):
+        with instrumented_backends():
+            for _ in range(renders):
+                if not self.cached:
+                    graph_cache.clear()
+                self.timed(self.render, lambda: self.client.get('/graph/'))
+
+    def report(self):
+        return {'ingest': self.ingest.report(), 'graph': self.render.report()}
+
+
+HTTPResponse = namedtuple('HTTPResponse', 'status_code content')
+
+
+class HTTPClient(object):
+    """Sends JSON requests to a running server, answering like the test
+    client."""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def request(self, method, path, data=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else None
+        request = urllib.request.Request(self.url + path, data=body, method=method,
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return HTTPResponse(response.status, response.read())
+        except urllib.error.HTTPError as exc:
+            return HTTPResponse(exc.code, exc.read())
+
+    def post(self, path, data, format=None):
+        return self.request('POST', path, data)
+
+    def get(self, path):
+        return self.request('GET', path)
+
+
+class LoadTest(Benchmark):
+    """Drives a running server over HTTP from ``concurrency`` threads, so the
+    throughput of gunicorn worker classes can be compared at a fixed number
+    of workers. Backend calls are made by the server, so they aren't counted,
+    and its graph cache is left alone."""
+
+    def __init__(self, url, concurrency, batch_size=None):
+        super().__init__(batch_size=batch_size, cached=True)
+        self.client = HTTPClient(url)
+        self.concurrency = concurrency
+
+    def run_concurrently(self, operation, requests):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            list(pool.map(lambda request: self.timed(operation, request), requests))
+        operation.elapsed = time.perf_counter() - start
+
+    def run_ingest(self, events):
+        if not self.batch_size:
+            requests = [lambda event=event: self.client.post('/microdot/', event)
+                        for event in events]
+        else:
+            events = list(events)
+            requests = [lambda batch=events[i:i + self.batch_size]:
+                        self.client.post('/microdot/batch/', batch)
+                        for i in range(0, len(events), self.batch_size)]
+        self.run_concurrently(self.ingest, requests)
+
+    def run_render(self, renders):
+        self.run_concurrently(self.render, [lambda: self.client.get('/graph/')] * renders)
+
+
+def run(events, renders, batch_size=None, cached=False, url=None, concurrency=1):
+    if url:
+        benchmark = LoadTest(url, concurrency, batch_size=batch_size)
+    else:
+        benchmark = Benchmark(batch_size=batch_size, cached=cached)
+    benchmark.run_ingest(events)
+    benchmark.run_render(renders)
+    return benchmark.report()
@@ -0,0 +1,101 @@
+from collections import Counter
+import atexit
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from .ingest import save_microdots
+from .sketches import merge_sketches
+
+logger = logging.getLogger(__name__)
+
+
+class AggregationBuffer(object):
+    """Coalesces microdot hits in memory and writes them behind the request.
+
+    Hits are counted by ``(origin, target, endpoint)``, and their latency
+    sketches merged. The buffer is flushed
+    by a background thread once its oldest hit is ``max_age`` seconds old, and
+    synchronously by the caller that makes it reach ``max_entries`` distinct
+    hits, which bounds its memory.
+    """
+
+    def __init__(self, flush_hits=save_microdots, max_entries=None, max_age=None,
+                 interval=None):
+        self.flush_hits = flush_hits
+        self.max_entries = max_entries or settings.MICRODOT_BUFFER_MAX_ENTRIES
+        self.max_age = max_age if max_age is not None else settings.MICRODOT_BUFFER_MAX_AGE
+        self.interval = interval or settings.MICRODOT_BUFFER_FLUSH_INTERVAL
+        self.hits = Counter()
+        self.latencies = {}
+        self.oldest = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def add(self, hit, count=1):
+        self.update({hit: count})
+
+    def update(self, hits, latencies=None):
+        with self.lock:
+            self.hits.update(hits)
+            for hit, sketch in (latencies or {}).items():
+                merge_sketches(self.latencies, hit, sketch)
+            if self.oldest is None:
+                self.oldest = time.time()
+            full = len(self.hits) >= self.max_entries
+        self.start()
+        if full:
+            self.flush()
+
+    def due(self):
+        with self.lock:
+            return self.oldest is not None and time.time() - self.oldest >= self.max_age
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                hits, self.hits = self.hits, Counter()
+                latencies, self.latencies = self.latencies, {}
+                self.oldest = None
+            if not hits:
+                return
+            try:
+                self.flush_hits(hits, latencies)
+            except Exception:
+                logger.exception('Dropped %d buffered microdot hits', sum(hits.values()))
+
+    def start(self):
+        """Starts the flusher thread, once per process."""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, name='microdot-buffer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if self.due():
+                self.flush()
+
+    def stop(self):
+        """Stops the flusher thread and writes whatever is still buffered."""
+        self.stopped.set()
+        if self.thread is not None and self.pid == os.getpid():
+            self.thread.join()
+        self.pid = None
+        self.flush()
+
+
+hit_buffer = AggregationBuffer()
+atexit.register(hit_buffer.stop)
@@ -0,0 +1,106 @@
+from collections import OrderedDict
+import threading
+import time
+
+from django.conf import settings
+
+from .compression import encode_etag
+
+
+class LRUCache(object):
+    """Thread-safe mapping holding at most ``maxsize`` entries, each expiring
+    ``ttl`` seconds after it was stored. The least recently used entry is
+    evicted first."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class GraphSnapshotCache(object):
+    """Keeps the last graphs rendered by this process.
+
+    Snapshots are identified by an ETag made of the graph version, bumped by
+    the backend whenever a write adds a vertex, an edge or an endpoint, and of
+    the current ``GRAPH_CACHE_TTL`` window, so endpoint counters are refreshed
+    at least once per window. Each ``variant`` of the graph, such as a time
+    window, is cached separately.
+    """
+    MAX_VARIANTS = 32
+
+    def __init__(self):
+        self.snapshots = LRUCache(self.MAX_VARIANTS, settings.GRAPH_CACHE_TTL)
+
+    @property
+    def backend(self):
+        return settings.PERSISTENT_BACKEND
+
+    def current_etag(self):
+        window = int(time.time() // settings.GRAPH_CACHE_TTL)
+        return '"{version}-{window}"'.format(version=self.backend.graph_version(),
+                                             window=window)
+
+    def get(self, etag, variant=None):
+        return self.snapshots.get((etag, variant))
+
+    def set(self, etag, data, variant=None):
+        self.snapshots.set((etag, variant), data)
+
+    def invalidate(self, changes=()):
+        """Bumps the graph version, logging the ``changes`` written, as
+        listed by ``api.changes``."""
+        self.backend.bump_graph_version(changes)
+        self.clear()
+
+    def clear(self):
+        self.snapshots.clear()
+
+
+def variant_etag(etag, *variant):
+    """Returns ``etag`` with the ``variant`` of the representation appended,
+    such as its format, as responses to the same URL differ by them."""
+    return '{}-{}"'.format(etag[:-1], '-'.join(variant))
+
+
+def etag_matches(etag, if_none_match, encoding=None):
+    """Tells whether ``etag``, or ``etag`` with the ``encoding`` appended by
+    ``CompressionMiddleware``, is listed in ``if_none_match``, ignoring weak
+    markers."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+    etags = {etag, encode_etag(etag, encoding)} if encoding else {etag}
+    return '*' in tags or not etags.isdisjoint(tags)
+
+
+graph_cache = GraphSnapshotCache()
@@ -0,0 +1,78 @@
+from collections import namedtuple
+import re
+
+from django.conf import settings
+
+from .backends import changed_buckets, current_bucket
+from .models import BaseGraph
+
+ADD = 'add'
+UPDATE = 'update'
+REMOVE = 'remove'
+VERSION = re.compile(r'^(\d+)-(\d+)$')
+
+Changes = namedtuple('Changes', 'version nodes edges added_nodes added_edges')
+
+
+def node_change(op, name):
+    return [op, 'node', name]
+
+
+def edge_changes(op, origin, target):
+    """Returns the changes logged when an edge is added or removed, which
+    changes the number of dependents of its target as well."""
+    return [[op, 'edge', origin, target], node_change(UPDATE, target)]
+
+
+def format_version(version, bucket):
+    return '{}-{}'.format(version, bucket)
+
+
+def parse_version(value):
+    """Returns the graph version and the bucket of the version ``value``, or
+    None if it isn't one."""
+    match = VERSION.match(value)
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+class ChangeFeed(BaseGraph):
+    """Tells which nodes and edges of ``GET /graph/`` changed since a version.
+
+    A version is made of the graph version, bumped with a log of the nodes
+    and edges added, updated or removed by each write, and of the current
+    endpoint bucket, as edge counters change without bumping it. The backend
+    keeps the edges hit in each bucket, which also tells the ones losing hits
+    once the bucket leaves the live window.
+    """
+
+    def current_version(self):
+        return format_version(self.backend.graph_version(), current_bucket())
+
+    def load(self, since):
+        """Returns the ``Changes`` since ``since``, a parsed version, with the
+        version they lead to, or None when they aren't known anymore."""
+        graph_version, bucket = since
+        now = current_bucket()
+        age = (now - bucket) * settings.ENDPOINT_BUCKET_SIZE
+        if not 0 <= age <= settings.GRAPH_CHANGES_RETENTION:
+            return None
+        version, logged = self.backend.load_graph_changes(graph_version)
+        if logged is None:
+            return None
+
+        nodes, edges, added_nodes, added_edges = set(), set(), set(), set()
+        for op, kind, *key in logged:
+            if kind == 'node':
+                changed, added, key = nodes, added_nodes, key[0]
+            else:
+                changed, added, key = edges, added_edges, tuple(key)
+            changed.add(key)
+            if op == ADD:
+                added.add(key)
+        edges.update(self.backend.load_changed_edges(changed_buckets(bucket)))
+        return Changes(format_version(version, now), nodes, edges, added_nodes, added_edges)
+
+
+change_feed = ChangeFeed()
@@ -0,0 +1,61 @@
+import re
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ACCEPTS_GZIP = re.compile(r'\bgzip\b')
+ACCEPTS_BROTLI = re.compile(r'\bbr\b')
+
+
+def brotli_compress(content):
+    return brotli.compress(content, quality=settings.RESPONSE_BROTLI_QUALITY)
+
+
+def choose_encoding(accept_encoding):
+    """Returns the name and function of the preferred encoding accepted, if
+    any. Brotli is only offered when the ``brotli`` package is installed."""
+    if brotli is not None and ACCEPTS_BROTLI.search(accept_encoding):
+        return 'br', brotli_compress
+    if ACCEPTS_GZIP.search(accept_encoding):
+        return 'gzip', compress_string
+    return None, None
+
+
+def encode_etag(etag, encoding):
+    """Returns ``etag`` with the ``encoding`` of the content appended."""
+    return re.sub(r'"$', ';{}"'.format(encoding), etag)
+
+
+class CompressionMiddleware(object):
+    """Compresses responses of at least ``RESPONSE_COMPRESSION_MIN_SIZE``
+    bytes with brotli or gzip, as accepted by the client.
+
+    Like Django's ``GZipMiddleware``, the encoding is appended to the ETag, so
+    caches keep the encodings apart.
+    """
+
+    def process_response(self, request, response):
+        if (response.streaming or response.has_header('Content-Encoding') or
+                len(response.content) < settings.RESPONSE_COMPRESSION_MIN_SIZE):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding, compress = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        content = compress(response.content)
+        if len(content) >= len(response.content):
+            return response
+        response.content = content
+        response['Content-Length'] = str(len(content))
+        response['Content-Encoding'] = encoding
+        if response.has_header('ETag'):
+            response['ETag'] = encode_etag(response['ETag'], encoding)
+        return response
@@ -0,0 +1,33 @@
+from django.conf import settings
+
+from .instrumentation import metrics
+
+try:
+    import gevent.pool
+    from gevent import monkey
+except ImportError:
+    gevent = None
+
+
+def cooperative():
+    """Tells whether the process runs on gevent with patched sockets, as in
+    the ``gunicorn_gevent.py`` profile."""
+    return gevent is not None and monkey.is_module_patched('socket')
+
+
+def concurrently(calls):
+    """Runs the independent backend ``calls`` and returns their results, in
+    order.
+
+    On gevent, up to ``CONCURRENT_BACKEND_CALLS`` of them run at once in
+    their own greenlets, which still count as the calling request for
+    ``metrics.track_calls``. Otherwise they run one after the other.
+    """
+    calls = list(calls)
+    size = settings.CONCURRENT_BACKEND_CALLS
+    if len(calls) < 2 or size < 2 or not cooperative():
+        return [call() for call in calls]
+    pool = gevent.pool.Pool(size)
+    greenlets = [pool.spawn(metrics.bind(call)) for call in calls]
+    gevent.joinall(greenlets, raise_error=True)
+    return [greenlet.value for greenlet in greenlets]
@@ -0,0 +1,23 @@
+import os
+import threading
+
+
+class ProcessLocal(object):
+    """Creates a value with ``factory`` on first use, and again in every
+    process forked afterwards, so connections are never shared between
+    gunicorn workers, even when the application is preloaded."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.pid = None
+        self.value = None
+
+    def get(self):
+        pid = os.getpid()
+        if self.pid != pid:
+            with self.lock:
+                if self.pid != pid:
+                    self.value = self.factory()
+                    self.pid = pid
+        return self.value
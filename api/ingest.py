@@ -0,0 +1,56 @@
+from collections import Counter, defaultdict
+
+from .cache import graph_cache
+from .changes import ADD, UPDATE, edge_changes, node_change
+from .concurrency import concurrently
+from .models import BaseGraph, Edge, Vertex
+from .sketches import merge_sketches
+
+
+def save_microdots(hits, latencies=None):
+    """Persists ``hits``, a mapping of ``(origin, target, endpoint)`` to a count,
+    and the ``LatencySketch`` of some of them in ``latencies``.
+
+    Each vertex and each relationship is looked up and saved once, no matter
+    how many hits reference it, and every endpoint hit is written to the
+    persistent backend in a single round trip. Lookups and saves of distinct
+    vertices, then of distinct relationships, run concurrently on gevent. New
+    vertices, endpoints and relationships are logged with the graph version
+    they bump.
+    """
+    if not hits:
+        return
+
+    pairs = defaultdict(Counter)
+    for (origin, target, endpoint), count in hits.items():
+        pairs[origin, target][endpoint] += count
+    names = list({name for pair in pairs for name in pair})
+    vertices = dict(zip(names, concurrently(lambda name=name: Vertex(name) for name in names)))
+    for (origin, target, endpoint) in hits:
+        vertices[target].add_endpoint(endpoint)
+
+    created = {name for name, vertex in vertices.items() if vertex.created}
+    saved = concurrently(vertex.save for vertex in vertices.values())
+    changes = [node_change(ADD if name in created else UPDATE, name)
+               for name, changed in zip(vertices, saved) if changed]
+
+    edges = concurrently(lambda pair=pair: Edge(vertices[pair[0]], vertices[pair[1]])
+                         for pair in pairs)
+    for edge, new in zip(edges, concurrently(edge.save for edge in edges)):
+        if new:
+            changes.extend(edge_changes(ADD, *edge.key))
+
+    endpoint_hits = Counter()
+    endpoint_latencies = {}
+    latencies = latencies or {}
+    for edge, ((origin, target), endpoints) in zip(edges, pairs.items()):
+        for endpoint, count in endpoints.items():
+            key = edge.name, edge.format_endpoint(endpoint)
+            endpoint_hits[key] += count
+            if (origin, target, endpoint) in latencies:
+                merge_sketches(endpoint_latencies, key, latencies[origin, target, endpoint])
+
+    BaseGraph.backend.save_endpoints(endpoint_hits, endpoint_latencies,
+                                     edges=[edge.key for edge in edges])
+    if changes:
+        graph_cache.invalidate(changes)
@@ -0,0 +1,222 @@
+from bisect import bisect_left
+from collections import Counter, defaultdict
+import contextlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+
+class MetricsRegistry(object):
+    """Latency histograms of this process, rendered in the Prometheus text
+    format.
+
+    Backend calls are also counted per request, for the thread running
+    ``track_calls``.
+    """
+    HELP = {
+        'microdots_backend_call_seconds':
+            'Latency of graph store, counter backend and Redis calls.',
+        'microdots_request_seconds': 'Latency of API requests.',
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = defaultdict(dict)
+        self.local = threading.local()
+
+    def observe(self, metric, labels, seconds):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            histogram = self.histograms[metric].get(labels)
+            if histogram is None:
+                histogram = self.histograms[metric][labels] = Histogram()
+            histogram.observe(seconds)
+
+    def record_call(self, component, operation, seconds):
+        self.observe('microdots_backend_call_seconds',
+                     {'component': component, 'operation': operation}, seconds)
+        calls = getattr(self.local, 'calls', None)
+        if calls is not None:
+            calls['{}.{}'.format(component, operation)] += 1
+
+    @contextlib.contextmanager
+    def track_calls(self):
+        """Counts the backend calls made by the current thread in the yielded
+        ``Counter``, by ``component.operation``."""
+        previous = getattr(self.local, 'calls', None)
+        calls = self.local.calls = Counter()
+        try:
+            yield calls
+        finally:
+            self.local.calls = previous
+            if previous is not None:
+                previous.update(calls)
+
+    def bind(self, function):
+        """Returns ``function`` counting its backend calls with those of the
+        current thread, to run it in another thread or greenlet."""
+        calls = getattr(self.local, 'calls', None)
+
+        def bound(*args, **kwargs):
+            self.local.calls = calls
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.local.calls = None
+        return bound
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for metric, histograms in sorted(self.histograms.items()):
+                lines.append('# HELP {} {}'.format(metric, self.HELP.get(metric, metric)))
+                lines.append('# TYPE {} histogram'.format(metric))
+                for labels, histogram in sorted(histograms.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append('{}_bucket{} {}'.format(
+                            metric, format_labels(labels + (('le', bound),)), cumulative))
+                    lines.append('{}_sum{} {}'.format(metric, format_labels(labels), histogram.sum))
+                    lines.append('{}_count{} {}'.format(metric, format_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+metrics = MetricsRegistry()
+
+
+class InstrumentedProxy(object):
+    """Wraps a graph store, a counter backend or a Redis client, recording the
+    latency of every public method call as ``component``."""
+
+    def __init__(self, target, component, registry=metrics):
+        self._target = target
+        self._component = component
+        self._registry = registry
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self._registry.record_call(self._component, name, time.perf_counter() - start)
+        self.__dict__[name] = call
+        return call
+
+
+class InstrumentedRedis(InstrumentedProxy):
+    """Records Redis commands, counting a pipeline as a single ``pipeline``
+    call when it is executed."""
+
+    def pipeline(self, *args, **kwargs):
+        return InstrumentedPipeline(self._target.pipeline(*args, **kwargs),
+                                    self._component, self._registry)
+
+
+class InstrumentedPipeline(object):
+    def __init__(self, pipeline, component, registry):
+        self._pipeline = pipeline
+        self._component = component
+        self._registry = registry
+
+    def __getattr__(self, name):
+        return getattr(self._pipeline, name)
+
+    def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._pipeline.execute(*args, **kwargs)
+        finally:
+            self._registry.record_call(self._component, 'pipeline', time.perf_counter() - start)
+
+
+def instrument(graph, backend):
+    """Returns proxies recording the calls made to ``graph``, to ``backend``
+    and to its Redis client, if it has one."""
+    if hasattr(backend, 'client_wrapper'):
+        backend.client_wrapper = lambda client: InstrumentedRedis(client, 'redis')
+    return InstrumentedProxy(graph, 'graph'), InstrumentedProxy(backend, 'counters')
+
+
+@contextlib.contextmanager
+def instrumented_backends():
+    """Makes sure graph store and counter backend calls are recorded, even
+    when ``INSTRUMENT_BACKENDS`` is off."""
+    from django.test import override_settings
+    from .models import BaseGraph
+
+    if isinstance(BaseGraph.graph, InstrumentedProxy):
+        yield
+        return
+
+    original = BaseGraph.graph, BaseGraph.backend
+    BaseGraph.graph = InstrumentedProxy(BaseGraph.graph, 'graph')
+    BaseGraph.backend = InstrumentedProxy(BaseGraph.backend, 'counters')
+    try:
+        with override_settings(GRAPH=BaseGraph.graph, PERSISTENT_BACKEND=BaseGraph.backend):
+            yield
+    finally:
+        BaseGraph.graph, BaseGraph.backend = original
+
+
+class InstrumentedViewMixin(object):
+    """Records the latency of each request, and the backend calls it made in
+    the ``X-Backend-Calls`` header when ``METRICS_RESPONSE_HEADER`` is on."""
+
+    def dispatch(self, request, *args, **kwargs):
+        start = time.perf_counter()
+        with metrics.track_calls() as calls:
+            response = super().dispatch(request, *args, **kwargs)
+        elapsed = time.perf_counter() - start
+        view = type(self).__name__
+        metrics.observe('microdots_request_seconds', {'view': view, 'method': request.method},
+                        elapsed)
+
+        summary = summarize_calls(calls)
+        if settings.METRICS_RESPONSE_HEADER:
+            response['X-Backend-Calls'] = summary
+        logger.debug('%s %s took %.1fms, backend calls: %s', request.method, view,
+                     elapsed * 1000, summary)
+        return response
+
+
+def summarize_calls(calls):
+    components = Counter()
+    for key, count in calls.items():
+        components[key.split('.', 1)[0]] += count
+    return ', '.join('{}={}'.format(k, v) for k, v in sorted(components.items()))
@@ -0,0 +1,155 @@
+from collections import Counter
+import asyncio
+import logging
+import math
+import time
+
+from django.conf import settings
+
+from .ingest import save_microdots
+from .normalizer import normalizer
+from .sketches import LatencySketch
+from .views import defer_hits, sample_hits
+
+logger = logging.getLogger(__name__)
+
+MAX_LINE_LENGTH = 4096
+
+
+def parse_line(line):
+    """Parses ``origin target METHOD /path [duration_ms]`` into the hit it
+    records, with its endpoint normalized, and its duration, if any. Raises
+    ValueError for any other line."""
+    fields = line.split()
+    if len(fields) not in (4, 5):
+        raise ValueError('Expected origin, target, method, path and duration: {!r}'.format(line))
+    origin, target, method, path = fields[:4]
+    duration = float(fields[4]) if len(fields) == 5 else None
+    if duration is not None and not (duration >= 0 and math.isfinite(duration)):
+        raise ValueError('Invalid duration: {!r}'.format(line))
+    endpoint = normalizer.normalize('{} {}'.format(method, path), target)
+    return (origin, target, endpoint), duration
+
+
+def store_hits(hits, latencies):
+    """Stores ``hits`` and their ``latencies`` the way ``POST /microdot/``
+    does: sampled, then buffered, queued or saved according to
+    ``MICRODOT_INGEST_MODE``."""
+    hits, _ = sample_hits(hits)
+    latencies = {hit: sketch for hit, sketch in latencies.items() if hit in hits}
+    if not defer_hits(hits, latencies):
+        save_microdots(hits, latencies)
+
+
+class MicrodotListener(object):
+    """Aggregates the microdots received as lines of text, and hands them to
+    ``store`` every ``interval`` seconds in a thread, so the event loop never
+    waits for Redis or Neo4j.
+
+    While a batch is being stored, lines of hits not aggregated yet are
+    dropped once ``max_entries`` distinct hits are waiting. ``counters``
+    holds the number of lines ``received``, ``dropped`` and failing to parse
+    (``parse_errors``).
+    """
+
+    def __init__(self, store=store_hits, max_entries=None, interval=None):
+        self.store = store
+        self.max_entries = max_entries or settings.MICRODOT_BUFFER_MAX_ENTRIES
+        self.interval = interval or settings.MICRODOT_LISTENER_FLUSH_INTERVAL
+        self.hits = Counter()
+        self.latencies = {}
+        self.counters = Counter()
+
+    def feed(self, data):
+        for line in data.splitlines():
+            self.receive(line)
+
+    def receive(self, line):
+        line = line.strip()
+        if not line:
+            return
+        try:
+            hit, duration = parse_line(line.decode('utf-8'))
+        except (UnicodeError, ValueError):
+            self.counters['parse_errors'] += 1
+            return
+        if hit not in self.hits and len(self.hits) >= self.max_entries:
+            self.counters['dropped'] += 1
+            return
+        self.counters['received'] += 1
+        self.hits[hit] += 1
+        if duration is not None:
+            self.latencies.setdefault(hit, LatencySketch()).add(duration)
+
+    def take(self):
+        """Returns the hits and latencies aggregated since the last call."""
+        hits, self.hits = self.hits, Counter()
+        latencies, self.latencies = self.latencies, {}
+        return hits, latencies
+
+    async def flush(self, loop):
+        hits, latencies = self.take()
+        if not hits:
+            return
+        try:
+            await loop.run_in_executor(None, self.store, hits, latencies)
+        except Exception:
+            logger.exception('Dropped %d received microdot hits', sum(hits.values()))
+            self.counters['dropped'] += sum(hits.values())
+
+    async def run(self, loop, report_interval=None):
+        """Flushes every ``interval`` seconds, logging the counters every
+        ``report_interval`` seconds."""
+        reported = time.time()
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush(loop)
+            if report_interval and time.time() - reported >= report_interval:
+                self.report()
+                reported = time.time()
+
+    def report(self):
+        logger.info('Microdot lines received: %d, dropped: %d, parse errors: %d',
+                    self.counters['received'], self.counters['dropped'],
+                    self.counters['parse_errors'])
+
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+    """Receives one or more lines per datagram."""
+
+    def __init__(self, listener):
+        self.listener = listener
+
+    def datagram_received(self, data, addr):
+        self.listener.feed(data)
+
+    def error_received(self, exc):
+        logger.warning('UDP receive error: %s', exc)
+
+
+class StreamProtocol(asyncio.Protocol):
+    """Receives lines over a TCP connection. Lines longer than
+    ``MAX_LINE_LENGTH`` bytes are dropped."""
+
+    def __init__(self, listener):
+        self.listener = listener
+        self.buffer = b''
+        self.skipping = False
+
+    def data_received(self, data):
+        *lines, self.buffer = (self.buffer + data).split(b'\n')
+        for line in lines:
+            if self.skipping:
+                self.skipping = False
+            else:
+                self.listener.receive(line)
+        if len(self.buffer) > MAX_LINE_LENGTH:
+            if not self.skipping:
+                self.listener.counters['dropped'] += 1
+            self.skipping = True
+            self.buffer = b''
+
+    def eof_received(self):
+        if not self.skipping:
+            self.listener.receive(self.buffer)
+        self.buffer = b''
@@ -0,0 +1,80 @@
+import json
+import random
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api import bench
+
+
+class Command(BaseCommand):
+    help = ('Measures POST /microdot/ and GET /graph/ against the configured stores, '
+            'printing throughput, latency percentiles and backend calls as JSON. '
+            'The stores are flushed first, unless --url is given.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--services', type=int, default=50)
+        parser.add_argument('--fan-out', type=int, default=3,
+                            help='Services called by each service.')
+        parser.add_argument('--endpoints', type=int, default=5,
+                            help='Endpoints of each service called by a dependent.')
+        parser.add_argument('--events', type=int, default=2000)
+        parser.add_argument('--zipf', type=float, default=1.1,
+                            help='Exponent of the Zipf distribution of the traffic.')
+        parser.add_argument('--replay', metavar='FILE',
+                            help='JSON lines file with the microdots to send, instead '
+                                 'of a synthetic topology.')
+        parser.add_argument('--renders', type=int, default=20)
+        parser.add_argument('--batch-size', type=int,
+                            help='Send microdots to /microdot/batch/ in batches of this size.')
+        parser.add_argument('--cached', action='store_true',
+                            help='Let GET /graph/ be answered by the snapshot cache.')
+        parser.add_argument('--url',
+                            help='Send the requests over HTTP to the server running at URL, '
+                                 'e.g. http://localhost:8000, instead of the test client.')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Number of clients sending requests at once with --url.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', metavar='FILE', help='Write the report to FILE.')
+        parser.add_argument('--noinput', action='store_false', dest='interactive')
+
+    def handle(self, *args, **options):
+        # A server given by --url keeps caching what it read from the stores,
+        # so they are only flushed when the requests are served in process.
+        if not options['url']:
+            self.flush(options['interactive'])
+
+        if options['replay']:
+            events = bench.replay_events(options['replay'])
+        else:
+            rng = random.Random(options['seed'])
+            calls = bench.synthetic_topology(options['services'], options['fan_out'],
+                                             options['endpoints'], rng)
+            events = bench.zipf_events(calls, options['events'], options['zipf'], rng)
+
+        report = bench.run(events, options['renders'], batch_size=options['batch_size'],
+                           cached=options['cached'], url=options['url'],
+                           concurrency=options['concurrency'])
+        report['settings'] = {
+            key: options[key] for key in ('services', 'fan_out', 'endpoints', 'events', 'zipf',
+                                          'replay', 'renders', 'batch_size', 'cached', 'url',
+                                          'concurrency', 'seed')
+        }
+        report['settings'].update(graph_backend=settings.GRAPH_BACKEND,
+                                  counter_backend=settings.COUNTER_BACKEND,
+                                  ingest_mode=settings.MICRODOT_INGEST_MODE)
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def flush(self, interactive):
+        if interactive and settings.GRAPH_BACKEND != 'memory':
+            answer = input('This purges all Neo4j and Redis data. Continue? [y/N] ')
+            if answer.lower() != 'y':
+                raise CommandError('Benchmark cancelled.')
+        settings.GRAPH.delete_all()
+        settings.PERSISTENT_BACKEND.flush_db()
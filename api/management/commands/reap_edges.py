@@ -0,0 +1,65 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import redis
+
+from api.reaper import Reaper
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Removes the dependencies without requests in the last GRAPH_MAX_WINDOW '
+            'seconds, once or periodically.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.REAPER_BATCH_SIZE,
+                            help='Edges checked and removed at once.')
+        parser.add_argument('--vertices', action='store_true',
+                            help='Also remove vertices without endpoints nor dependencies.')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep running, reaping every INTERVAL seconds.')
+        parser.add_argument('--listen', action='store_true',
+                            help='Keep running, reaping when Redis reports expired keys, '
+                                 'at most once every --interval seconds, and never more '
+                                 'than once every REAPER_MIN_LISTEN_INTERVAL seconds.')
+
+    def handle(self, *args, **options):
+        reaper = Reaper(batch_size=options['batch_size'])
+        if options['listen']:
+            interval = max(options['interval'], settings.REAPER_MIN_LISTEN_INTERVAL)
+            self.listen(reaper, options['vertices'], interval)
+        elif options['interval']:
+            while True:
+                self.reap(reaper, options['vertices'])
+                time.sleep(options['interval'])
+        else:
+            self.reap(reaper, options['vertices'])
+
+    def reap(self, reaper, vertices):
+        edges, vertices = reaper.reap(vertices=vertices)
+        self.stdout.write('Removed {} edges and {} vertices'.format(edges, vertices))
+
+    def listen(self, reaper, vertices, interval):
+        client = getattr(settings.PERSISTENT_BACKEND, 'redis_server', None)
+        if client is None:
+            raise CommandError('--listen needs the Redis counter backend.')
+        try:
+            client.config_set('notify-keyspace-events', 'Ex')
+        except redis.ResponseError:
+            logger.warning('Could not enable keyspace notifications, '
+                           'they must be enabled in the Redis configuration')
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe('__keyevent@*__:expired')
+
+        last = 0
+        pending = True
+        while True:
+            message = pubsub.get_message(timeout=1)
+            pending = pending or message is not None
+            if pending and time.time() - last >= interval:
+                self.reap(reaper, vertices)
+                last = time.time()
+                pending = False
@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.listener import DatagramProtocol, MicrodotListener, StreamProtocol
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Receives microdots as "origin target METHOD /path [duration_ms]" lines over UDP '
+            'and TCP, and stores them like POST /microdot/.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='0.0.0.0',
+                            help='Address to listen on.')
+        parser.add_argument('--udp-port', type=int, default=settings.MICRODOT_LISTENER_PORT,
+                            help='UDP port to listen on, 0 to disable UDP.')
+        parser.add_argument('--tcp-port', type=int, default=settings.MICRODOT_LISTENER_PORT,
+                            help='TCP port to listen on, 0 to disable TCP.')
+        parser.add_argument('--interval', type=float,
+                            default=settings.MICRODOT_LISTENER_FLUSH_INTERVAL,
+                            help='Seconds between two writes of the received hits.')
+        parser.add_argument('--max-entries', type=int,
+                            default=settings.MICRODOT_BUFFER_MAX_ENTRIES,
+                            help='Distinct hits kept while a write is running, before '
+                                 'dropping new ones.')
+        parser.add_argument('--report-interval', type=int, default=60,
+                            help='Seconds between two logs of the received, dropped and '
+                                 'invalid lines counters.')
+
+    def handle(self, *args, **options):
+        loop = asyncio.get_event_loop()
+        listener = MicrodotListener(max_entries=options['max_entries'],
+                                    interval=options['interval'])
+        transports = []
+        if options['udp_port']:
+            transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(
+                lambda: DatagramProtocol(listener),
+                local_addr=(options['host'], options['udp_port'])))
+            transports.append(transport)
+        if options['tcp_port']:
+            transports.append(loop.run_until_complete(loop.create_server(
+                lambda: StreamProtocol(listener), options['host'], options['tcp_port'])))
+        logger.info('Listening on %s, UDP port %d, TCP port %d', options['host'],
+                    options['udp_port'], options['tcp_port'])
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, loop.stop)
+        task = loop.create_task(listener.run(loop, options['report_interval']))
+        try:
+            loop.run_forever()
+        finally:
+            task.cancel()
+            loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+            for transport in transports:
+                transport.close()
+            loop.run_until_complete(listener.flush(loop))
+            listener.report()
+            loop.close()
@@ -0,0 +1,82 @@
+from collections import Counter
+import logging
+import os
+import signal
+import socket
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.ingest import save_microdots
+from api.sketches import LatencySketch, merge_sketches
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Stores the microdots queued by POST /microdot/ in the queue ingest mode.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.MICRODOT_WORKER_BATCH_SIZE,
+                            help='Maximum number of queued events stored at once.')
+        parser.add_argument('--worker-id',
+                            default='{}.{}'.format(os.environ.get('DYNO', socket.gethostname()),
+                                                   os.getpid()),
+                            help='Name of this worker, unique among running workers. Events '
+                                 'left unacknowledged by a previous run with the same name, '
+                                 'or by workers gone for MICRODOT_WORKER_LEASE seconds, are '
+                                 'queued again.')
+        parser.add_argument('--max-attempts', type=int,
+                            default=settings.MICRODOT_WORKER_MAX_ATTEMPTS,
+                            help='Failed attempts to store an event before moving it to the '
+                                 'dead-letter list.')
+        parser.add_argument('--timeout', type=int, default=settings.MICRODOT_WORKER_TIMEOUT,
+                            help='Seconds to wait for new events before checking for shutdown.')
+        parser.add_argument('--recovery-interval', type=int,
+                            default=settings.MICRODOT_WORKER_RECOVERY_INTERVAL,
+                            help='Seconds between two checks for the events of workers gone '
+                                 'for MICRODOT_WORKER_LEASE seconds.')
+
+    def handle(self, *args, **options):
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        backend = settings.PERSISTENT_BACKEND
+        worker = options['worker_id']
+        recovered = backend.recover_microdots(worker)
+        if recovered:
+            logger.warning('Queued again %d events left by worker %s', recovered, worker)
+
+        recovered_at = 0
+        while self.running:
+            if time.time() - recovered_at >= options['recovery_interval']:
+                recovered = backend.recover_abandoned_microdots()
+                if recovered:
+                    logger.warning('Queued again %d events left by stopped workers', recovered)
+                recovered_at = time.time()
+
+            events = backend.dequeue_microdots(worker, options['batch_size'], options['timeout'])
+            if not events:
+                continue
+
+            hits = Counter()
+            latencies = {}
+            for event in events:
+                hit = event['origin'], event['target'], event['endpoint']
+                hits[hit] += event['count']
+                if 'latency' in event:
+                    merge_sketches(latencies, hit, LatencySketch.from_fields(event['latency']))
+            try:
+                save_microdots(hits, latencies)
+            except Exception:
+                retried, dead = backend.retry_microdots(worker, options['max_attempts'])
+                logger.exception('Failed to store %d events, queued %d of them again and '
+                                 'moved %d to the dead-letter list', len(events), retried, dead)
+                time.sleep(1)
+            else:
+                backend.ack_microdots(worker)
+
+    def stop(self, signum, frame):
+        self.running = False
@@ -1,9 +1,87 @@
 from collections import Counter
-import re
+import itertools
 
 from py2neo import Node, Relationship
 
 from django.conf import settings
+import numpy as np
+
+from .cache import LRUCache
+from .concurrency import concurrently
+from .normalizer import normalizer
+
+vertex_cache = LRUCache(settings.GRAPH_LOOKUP_CACHE_SIZE, settings.GRAPH_LOOKUP_CACHE_TTL)
+edge_cache = LRUCache(settings.GRAPH_LOOKUP_CACHE_SIZE, settings.GRAPH_LOOKUP_CACHE_TTL)
+
+
+def endpoint_usage(endpoints, used):
+    """Returns the percentage of ``endpoints`` found in ``used``."""
+    endpoints = set(endpoints or [])
+    if not endpoints:
+        return 0.0
+    return len(endpoints.intersection(used)) * 100 / len(endpoints)
+
+
+def vertex_size(dependents, minimum, maximum, nodes_number):
+    min_settings, max_settings = settings.NODE_SIZE
+    max_settings = min(max_settings, nodes_number)
+    factor = (max_settings - min_settings) * (dependents - minimum)
+    return (factor / max(1, (maximum - minimum))) + min_settings
+
+
+def vertex_sizes(dependents, nodes_number, minimum=None, maximum=None):
+    """Returns the ``vertex_size`` of vertices with ``dependents``, all at
+    once. The smallest and largest numbers of dependents default to those
+    found in ``dependents``."""
+    dependents = np.asarray(dependents, dtype=np.float64)
+    if not dependents.size:
+        return dependents
+    lowest = dependents.min() if minimum is None else min(minimum, dependents.min())
+    highest = dependents.max() if maximum is None else max(maximum, dependents.max())
+    min_settings, max_settings = settings.NODE_SIZE
+    max_settings = min(max_settings, nodes_number)
+    return ((max_settings - min_settings) * (dependents - lowest) / max(1, highest - lowest) +
+            min_settings)
+
+
+def endpoint_usages(endpoints, targets, used):
+    """Returns the ``endpoint_usage`` of many edges at once. ``endpoints``
+    lists the endpoints of each target vertex, once, ``targets`` the index of
+    the target of each edge and ``used`` its used endpoints.
+
+    Endpoints are numbered with a single sort, so each (target, endpoint)
+    pair is an integer, and the used endpoints of every edge are looked up
+    together.
+    """
+    endpoints = [list(e or ()) for e in endpoints]
+    used = [list(u) for u in used]
+    sizes = np.array([len(e) for e in endpoints], dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    names = list(itertools.chain.from_iterable(endpoints))
+    known_count = len(names)
+    names.extend(itertools.chain.from_iterable(used))
+    if not names:
+        return np.zeros(len(used))
+
+    _, ids = np.unique(names, return_inverse=True)
+    known = np.repeat(np.arange(len(endpoints)), sizes) * len(names) + ids[:known_count]
+    owners = np.repeat(np.arange(len(used)), [len(u) for u in used])
+    found = np.in1d(targets[owners] * len(names) + ids[known_count:], known)
+    matches = np.bincount(owners[found], minlength=len(used))
+    totals = sizes[targets]
+    return np.where(totals > 0, matches * 100 / np.maximum(totals, 1), 0.0)
+
+
+def edge_usages(edges):
+    """Returns the ``endpoint_usage`` of every edge of ``edges`` from its
+    ``endpoint_counts``, reading the endpoints of each target once."""
+    positions, endpoints = {}, []
+    for edge in edges:
+        if edge.node_to not in positions:
+            positions[edge.node_to] = len(endpoints)
+            endpoints.append(edge.target.node['endpoints'])
+    return endpoint_usages(endpoints, [positions[edge.node_to] for edge in edges],
+                           [edge.endpoint_counts for edge in edges])
 
 
 class BaseGraph(object):
@@ -11,8 +89,7 @@ class BaseGraph(object):
     graph = settings.GRAPH
 
     def format_endpoint(self, endpoint):
-        endpoint = re.sub(r'/\d+', '/{id}', endpoint)
-        return re.sub(r'\?.*', '', endpoint)
+        return normalizer.normalize(endpoint)
 
 
 class Vertex(BaseGraph):
@@ -24,14 +101,20 @@ class Vertex(BaseGraph):
         self.dependents = None
         self.max_know_depedents = 0
         self.min_know_depedents = 0
+        self.created = False
         self.node = self.instantiate_node(name)
         if endpoint:
-            self.endpoints.add(self.format_endpoint(endpoint))
+            self.add_endpoint(endpoint)
 
     def instantiate_node(self, name):
-        node = self.graph.find_one(self.LABEL, property_key='name', property_value=name)
+        node = vertex_cache.get(name)
+        if node is None:
+            node = self.graph.find_one(self.LABEL, property_key='name', property_value=name)
+            if node:
+                vertex_cache.set(name, node)
         if not node:
             node = Node(self.LABEL, name=name)
+            self.created = True
         self.name = node['name']
 
         self.endpoints = node['endpoints']
@@ -42,6 +125,13 @@ class Vertex(BaseGraph):
 
         return node
 
+    def format_endpoint(self, endpoint):
+        endpoint = normalizer.normalize(endpoint, self.name)
+        return normalizer.fold(endpoint, self.endpoints)
+
+    def add_endpoint(self, endpoint):
+        self.endpoints.add(self.format_endpoint(endpoint))
+
     @property
     def dependents_number(self):
         self.update_dependents()
@@ -57,18 +147,30 @@ class Vertex(BaseGraph):
         return self.dependents
 
     def calc_vertex_size(self, minimum, maximum, nodes_number):
-        min_settings, max_settings = settings.NODE_SIZE
-        max_settings = min(max_settings, nodes_number)
-        factor = (max_settings - min_settings) * (len(self.dependents) - minimum)
-        self.vertex_size = (factor / max(1, (maximum - minimum))) + min_settings
+        self.vertex_size = vertex_size(len(self.dependents), minimum, maximum, nodes_number)
         return self.vertex_size
 
     def save(self):
-        self.node['endpoints'] = list(self.endpoints)
-        if self.graph.exists(self.node):
-            self.graph.push(self.node)
-        else:
+        """Saves the vertex, returning whether it or its endpoints are new.
+
+        Nothing is written when the vertex already stores all its endpoints.
+        Otherwise the node is pulled first, so endpoints added meanwhile by
+        other processes are kept.
+        """
+        if self.created:
+            self.node['endpoints'] = list(self.endpoints)
             self.graph.create(self.node)
+            vertex_cache.set(self.name, self.node)
+            self.created = False
+            return True
+
+        if self.endpoints == set(self.node['endpoints'] or []):
+            return False
+        self.graph.pull(self.node)
+        self.endpoints.update(self.node['endpoints'] or [])
+        self.node['endpoints'] = list(self.endpoints)
+        self.graph.push(self.node)
+        return True
 
 
 class Edge(BaseGraph):
@@ -78,20 +180,43 @@ class Edge(BaseGraph):
         self.origin = origin
         self.target = target
         self.endpoint = endpoint
+        self.endpoint_counts = None
+        self.latencies = None
+        self.usage = None
+        self.created = False
         self.relationship = self.instantiate_relationship(origin.node, target.node)
 
     def instantiate_relationship(self, origin_node, target_node):
-        relationship = self.graph.match_one(start_node=origin_node,
-                                            rel_type=self.TYPE,
-                                            end_node=target_node)
+        key = (origin_node['name'], target_node['name'])
+        relationship = edge_cache.get(key)
+        if relationship is None and not (self.origin.created or self.target.created):
+            relationship = self.graph.match_one(start_node=origin_node,
+                                                rel_type=self.TYPE,
+                                                end_node=target_node)
+            if relationship is not None:
+                edge_cache.set(key, relationship)
         if relationship is None:
             name = origin_node['name'] + '-' + target_node['name']
             relationship = Relationship(origin_node, self.TYPE, target_node, name=name)
+            self.created = True
         return relationship
 
+    @property
+    def key(self):
+        return self.origin.name, self.target.name
+
+    def format_endpoint(self, endpoint):
+        return self.target.format_endpoint(endpoint)
+
     def load_endpoints(self):
-        endpoints = self.backend.load_endpoints(self.name)
-        return Counter(endpoints)
+        if self.endpoint_counts is None:
+            self.endpoint_counts = Counter(self.backend.load_endpoints(self.name))
+        return self.endpoint_counts
+
+    def load_latencies(self):
+        if self.latencies is None:
+            self.latencies = self.backend.load_latencies_many([self.name])[self.name]
+        return self.latencies
 
     @property
     def name(self):
@@ -107,16 +232,129 @@ class Edge(BaseGraph):
 
     def save_endpoint(self, endpoint):
         endpoint = self.format_endpoint(endpoint)
-        self.backend.save_endpoint(self.name, endpoint)
+        self.backend.save_endpoints({(self.name, endpoint): 1}, edges=[self.key])
+        self.endpoint_counts = None
 
     def save(self):
-        if self.graph.exists(self.relationship):
-            self.graph.push(self.relationship)
-        else:
+        """Saves the edge and its endpoint hit, returning whether it is new."""
+        created = self.created
+        if created:
             self.graph.create(self.relationship)
+            edge_cache.set(self.key, self.relationship)
+            self.created = False
 
         if self.endpoint:
             self.save_endpoint(self.endpoint)
+        return created
 
     def delete(self):
         self.graph.separate(self.relationship)
+        edge_cache.invalidate(self.key)
+
+
+class VertexRecord(object):
+    """Read-only vertex materialized from a bulk graph query."""
+
+    def __init__(self, name, endpoints, dependents_number):
+        self.name = name
+        self.endpoints = set(endpoints or [])
+        self.node = {'name': name, 'endpoints': list(endpoints or [])}
+        self.dependents_number = dependents_number
+        self.vertex_size = None
+
+
+class EdgeRecord(BaseGraph):
+    """Read-only edge materialized from a bulk graph query."""
+
+    def __init__(self, id, name, origin, target):
+        self.id = id
+        self.name = name
+        self.origin = origin
+        self.target = target
+        self.endpoint_counts = None
+        self.latencies = None
+        self.usage = None
+
+    def load_endpoints(self):
+        if self.endpoint_counts is None:
+            self.endpoint_counts = Counter(self.backend.load_endpoints(self.name))
+        return self.endpoint_counts
+
+    def load_latencies(self):
+        if self.latencies is None:
+            self.latencies = self.backend.load_latencies_many([self.name])[self.name]
+        return self.latencies
+
+    @property
+    def node_from(self):
+        return self.origin.name
+
+    @property
+    def node_to(self):
+        return self.target.name
+
+
+class GraphReader(BaseGraph):
+    """Loads the whole graph, or the neighborhood of a vertex, with a fixed
+    number of queries."""
+
+    def load_vertices(self, **filters):
+        """Loads the vertices, filtered and paginated by name as described by
+        ``GraphStore.vertex_rows``."""
+        return [VertexRecord(r['name'], r['endpoints'], r['dependents'])
+                for r in self.graph.vertex_rows(Vertex.LABEL, Edge.TYPE, **filters)]
+
+    def load_edges(self, vertices, **filters):
+        """Loads the edges leaving the vertices loaded with the same
+        ``filters``, sharing the records in ``vertices`` as endpoints."""
+        return self.edge_records(vertices, self.graph.edge_rows(Vertex.LABEL, Edge.TYPE, **filters))
+
+    def load_graph(self, **filters):
+        """Loads the vertices and the edges leaving them, querying both at
+        once on gevent."""
+        vertex_rows, edge_rows = concurrently([
+            lambda: self.graph.vertex_rows(Vertex.LABEL, Edge.TYPE, **filters),
+            lambda: self.graph.edge_rows(Vertex.LABEL, Edge.TYPE, **filters),
+        ])
+        vertices = [VertexRecord(r['name'], r['endpoints'], r['dependents'])
+                    for r in vertex_rows]
+        return vertices, self.edge_records(vertices, edge_rows)
+
+    def edge_records(self, vertices, rows):
+        by_name = {v.name: v for v in vertices}
+        edges = []
+        for r in rows:
+            origin = by_name.get(r['origin']) or VertexRecord(r['origin'], r['origin_endpoints'], 0)
+            target = by_name.get(r['target']) or VertexRecord(r['target'], r['target_endpoints'], 0)
+            edges.append(EdgeRecord(r['id'], r['name'], origin, target))
+        return edges
+
+    def vertex_stats(self, prefix=None, pattern=None):
+        return self.graph.vertex_stats(Vertex.LABEL, Edge.TYPE, prefix, pattern)
+
+    def load_subgraph(self, name, depth, direction):
+        """Loads the vertices up to ``depth`` hops from the one named ``name``
+        and the edges between them. Their dependents are counted within the
+        subgraph."""
+        vertex_rows, edge_rows = self.graph.subgraph_rows(Vertex.LABEL, Edge.TYPE, name,
+                                                          depth, direction)
+        dependents = Counter(r['target'] for r in edge_rows)
+        vertices = [VertexRecord(r['name'], r['endpoints'], dependents[r['name']])
+                    for r in vertex_rows]
+        by_name = {v.name: v for v in vertices}
+        edges = [EdgeRecord(r['id'], r['name'], by_name[r['origin']], by_name[r['target']])
+                 for r in edge_rows]
+        return vertices, edges
+
+    def load_named(self, names, pairs):
+        """Loads the vertices named in ``names`` and the edges between the
+        ``(origin, target)`` names of ``pairs``, leaving out missing ones."""
+        vertex_rows, edge_rows = self.graph.named_rows(Vertex.LABEL, Edge.TYPE, names, pairs)
+        vertices = [VertexRecord(r['name'], r['endpoints'], r['dependents'])
+                    for r in vertex_rows]
+        return vertices, self.edge_records(vertices, edge_rows)
+
+    def delete_edges(self, edges):
+        self.graph.delete_relationships(Edge.TYPE, [e.id for e in edges])
+        for edge in edges:
+            edge_cache.invalidate((edge.node_from, edge.node_to))
@@ -0,0 +1,72 @@
+from functools import lru_cache
+import re
+
+from django.conf import settings
+
+
+SEGMENT_RULES = (
+    (re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$'),
+     '{uuid}'),
+    (re.compile(r'^\d{4}-\d{2}-\d{2}$'), '{date}'),
+    (re.compile(r'^\d+$'), '{id}'),
+    (re.compile(r'^[0-9a-fA-F]{16,}$'), '{hash}'),
+)
+QUERY_STRING = re.compile(r'\?.*')
+TEMPLATE_VARIABLE = re.compile(r'(\{[^}/]+\})')
+OVERFLOW_PATH = '/{other}'
+
+
+def compile_template(template):
+    """Compiles a path template such as ``/users/{uuid}``, where every
+    variable matches one path segment."""
+    parts = TEMPLATE_VARIABLE.split(template)
+    pattern = ''.join('[^/]+' if TEMPLATE_VARIABLE.match(p) else re.escape(p) for p in parts)
+    return re.compile('^' + pattern + '$')
+
+
+class EndpointNormalizer(object):
+    """Turns requested endpoints into templates, so every call to the same
+    resource is counted under the same endpoint.
+
+    Paths are first matched against the templates configured for the target
+    service; otherwise ids, UUIDs, dates and hashes found in path segments are
+    replaced by placeholders. Results are memoized.
+    """
+
+    def __init__(self, templates=None, cache_size=None, max_endpoints=None):
+        self.templates = {
+            service: [(compile_template(t), t) for t in service_templates]
+            for service, service_templates in (templates or {}).items()
+        }
+        self.max_endpoints = max_endpoints
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+
+    def _normalize(self, endpoint, service=None):
+        endpoint = QUERY_STRING.sub('', endpoint)
+        method, separator, path = endpoint.rpartition(' ')
+        return method + separator + self.normalize_path(path, service)
+
+    def normalize_path(self, path, service=None):
+        for pattern, template in self.templates.get(service, ()):
+            if pattern.match(path):
+                return template
+        return '/'.join(self.normalize_segment(segment) for segment in path.split('/'))
+
+    def normalize_segment(self, segment):
+        for pattern, placeholder in SEGMENT_RULES:
+            if pattern.match(segment):
+                return placeholder
+        return segment
+
+    def fold(self, endpoint, known):
+        """Returns ``endpoint``, or the overflow endpoint of its method once a
+        service already knows ``max_endpoints`` other endpoints."""
+        if self.max_endpoints is None or endpoint in known or len(known) < self.max_endpoints:
+            return endpoint
+        method, separator, _ = endpoint.rpartition(' ')
+        return method + separator + OVERFLOW_PATH
+
+
+normalizer = EndpointNormalizer(settings.ENDPOINT_TEMPLATES,
+                                settings.ENDPOINT_NORMALIZER_CACHE_SIZE,
+                                settings.ENDPOINT_MAX_PER_SERVICE)
@@ -0,0 +1,33 @@
+import json
+
+from django.conf import settings
+from django.utils import six
+import msgpack
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+class JSONLinesParser(BaseParser):
+    """Parses a body holding one JSON document per line into a list."""
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+
+        try:
+            data = stream.read().decode(encoding)
+            return [json.loads(line) for line in data.splitlines() if line.strip()]
+        except ValueError as exc:
+            raise ParseError('JSON lines parse error - %s' % six.text_type(exc))
+
+
+class MessagePackParser(BaseParser):
+    """Parses a MessagePack body."""
+    media_type = 'application/msgpack'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), encoding='utf-8')
+        except (ValueError, msgpack.UnpackException) as exc:
+            raise ParseError('MessagePack parse error - %s' % six.text_type(exc))
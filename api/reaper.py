@@ -0,0 +1,48 @@
+import logging
+
+from django.conf import settings
+
+from .cache import graph_cache
+from .changes import REMOVE, edge_changes, node_change
+from .models import BaseGraph, Edge, GraphReader, Vertex, vertex_cache
+
+logger = logging.getLogger(__name__)
+
+
+class Reaper(BaseGraph):
+    """Removes the ``Depends`` relationships without endpoint hits in the last
+    ``GRAPH_MAX_WINDOW`` seconds, so they can still be shown by windowed
+    graphs, and, optionally, the vertices left without endpoints nor
+    relationships."""
+
+    def __init__(self, batch_size=None):
+        self.reader = GraphReader()
+        self.batch_size = batch_size or settings.REAPER_BATCH_SIZE
+
+    def reap(self, vertices=False):
+        """Returns the number of edges and vertices removed."""
+        edges = self.reader.load_edges([])
+        removed_edges = 0
+        changes = []
+        for start in range(0, len(edges), self.batch_size):
+            batch = edges[start:start + self.batch_size]
+            counters = self.backend.load_rollups_many((edge.name for edge in batch),
+                                                      settings.GRAPH_MAX_WINDOW)
+            stale = [edge for edge in batch if not counters[edge.name]]
+            self.reader.delete_edges(stale)
+            removed_edges += len(stale)
+            for edge in stale:
+                changes.extend(edge_changes(REMOVE, edge.node_from, edge.node_to))
+
+        removed_vertices = []
+        if vertices:
+            removed_vertices = self.graph.delete_orphan_vertices(Vertex.LABEL, Edge.TYPE)
+            for name in removed_vertices:
+                vertex_cache.invalidate(name)
+                changes.append(node_change(REMOVE, name))
+
+        if changes:
+            graph_cache.invalidate(changes)
+            logger.info('Removed %d stale edges and %d vertices',
+                        removed_edges, len(removed_vertices))
+        return removed_edges, len(removed_vertices)
@@ -0,0 +1,48 @@
+import msgpack
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+
+def pack_default(obj):
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError('Cannot serialize {!r}'.format(obj))
+
+
+class MessagePackRenderer(BaseRenderer):
+    """Renders data as MessagePack, requested with ``Accept:
+    application/msgpack`` or ``?format=msgpack``."""
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, use_bin_type=True, default=pack_default)
+
+
+def format_event(data=None, id=None, event=None):
+    """Returns a Server-Sent Event. Without ``data``, clients only take the
+    ``id`` as the last event id."""
+    lines = []
+    if id is not None:
+        lines.append('id: {}'.format(id))
+    if event is not None:
+        lines.append('event: {}'.format(event))
+    if data is not None:
+        lines.extend('data: {}'.format(line) for line in data.splitlines())
+    return '\n'.join(lines) + '\n\n'
+
+
+class EventStreamRenderer(BaseRenderer):
+    """Renders data as a single ``error`` event for ``Accept:
+    text/event-stream`` clients. Streams write their events themselves."""
+    media_type = 'text/event-stream'
+    format = 'sse'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return format_event(JSONRenderer().render(data).decode('utf-8'),
+                            event='error').encode('utf-8')
@@ -0,0 +1,96 @@
+from collections import Counter
+import math
+import random
+import threading
+import time
+
+from django.conf import settings
+
+from .normalizer import normalizer
+
+
+class AdaptiveSampler(object):
+    """Stores a fraction of the hits of busy ``(origin, target, endpoint)``
+    triples.
+
+    Hits are counted per triple, with endpoints normalized, over windows of
+    ``window`` seconds. Once a triple had more than ``threshold`` hits per
+    second in the previous window, its hits are kept with a probability
+    bringing it back to the threshold, and kept hits are weighted by the
+    inverse of that probability, so counts remain unbiased estimates. Triples
+    new to the window are always kept. A ``threshold`` of 0 disables sampling.
+    """
+
+    def __init__(self, threshold=None, window=None, rng=None):
+        self._threshold = threshold
+        self._window = window
+        self.rng = rng or random.Random()
+        self.current = Counter()
+        self.previous = Counter()
+        self.started = 0
+        self.lock = threading.Lock()
+
+    @property
+    def threshold(self):
+        if self._threshold is not None:
+            return self._threshold
+        return settings.MICRODOT_SAMPLING_THRESHOLD
+
+    @property
+    def window(self):
+        return self._window or settings.MICRODOT_SAMPLING_WINDOW
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def roll(self, now):
+        elapsed = now - self.started
+        if elapsed < self.window:
+            return
+        self.previous = self.current if elapsed < 2 * self.window else Counter()
+        self.current = Counter()
+        self.started = now - now % self.window
+
+    def sample_rate(self, key):
+        limit = self.threshold * self.window
+        count = self.previous[key]
+        return 1.0 if count <= limit else limit / count
+
+    def weigh(self, count, rate):
+        """Returns a random integer weight averaging ``count / rate``."""
+        weight = count / rate
+        floor = math.floor(weight)
+        return int(floor) + (self.rng.random() < weight - floor)
+
+    def sample(self, hits):
+        """Samples ``hits``, a mapping of ``(origin, target, endpoint)`` to a
+        count, returning the hits to store with their weights and the lowest
+        sample rate applied."""
+        if not self.enabled:
+            return hits, 1.0
+
+        kept = Counter()
+        lowest = 1.0
+        with self.lock:
+            self.roll(time.time())
+            for hit, count in hits.items():
+                origin, target, endpoint = hit
+                key = origin, target, normalizer.normalize(endpoint, target)
+                self.current[key] += count
+                rate = self.sample_rate(key)
+                lowest = min(lowest, rate)
+                if rate >= 1:
+                    kept[hit] += count
+                elif self.rng.random() < rate:
+                    kept[hit] += self.weigh(count, rate)
+        return kept, lowest
+
+    def clear(self):
+        with self.lock:
+            self.current = Counter()
+            self.previous = Counter()
+            self.started = 0
+
+
+sampler = AdaptiveSampler()
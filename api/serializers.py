@@ -1,44 +1,66 @@
+from collections import Counter
+
 from rest_framework import serializers
 
-from .models import Edge, Vertex
+from .ingest import save_microdots
+from .models import endpoint_usage
+from .sketches import LatencySketch
+
+
+class ProjectionMixin(object):
+    """Leaves out the fields missing from the ``fields`` set of the context,
+    if any, without computing them. ``id`` is always included."""
 
+    def wants(self, field):
+        fields = self.context.get('fields')
+        return not fields or field == 'id' or field in fields
 
-class EdgeSerializer(serializers.Serializer):
+    def project(self, obj, getters):
+        return {field: getter(obj) for field, getter in getters if self.wants(field)}
+
+
+class EdgeSerializer(ProjectionMixin, serializers.Serializer):
     node_from = serializers.CharField()
     node_to = serializers.CharField()
 
     def to_representation(self, obj):
-        return {
-            'from': obj.node_from,
-            'to': obj.node_to,
-            'usage': self.get_endpoint_usage(obj),
-            'id': obj.name,
-            'endpoints': self.get_endpoints(obj),
-        }
+        return self.project(obj, (
+            ('from', lambda obj: obj.node_from),
+            ('to', lambda obj: obj.node_to),
+            ('usage', self.get_endpoint_usage),
+            ('id', lambda obj: obj.name),
+            ('endpoints', self.get_endpoints),
+        ))
 
     def get_endpoint_usage(self, obj):
-        total = set(obj.target.node['endpoints'])
-        partial = set(obj.load_endpoints().keys())
-        intersection = total.intersection(partial)
-        usage = len(intersection) * 100 / len(total)
+        usage = obj.usage
+        if usage is None:
+            usage = endpoint_usage(obj.target.node['endpoints'], obj.load_endpoints())
         return '{:.1f}%'.format(usage)
 
     def get_endpoints(self, obj):
         endpoints = obj.load_endpoints()
-        return [{'endpoint': e, 'access': endpoints[e]} for e in endpoints]
+        latencies = obj.load_latencies()
+        return [self.get_endpoint(e, endpoints[e], latencies.get(e)) for e in endpoints]
+
+    def get_endpoint(self, endpoint, access, latency):
+        representation = {'endpoint': endpoint, 'access': access}
+        if latency:
+            representation.update(latency.summary())
+        return representation
 
 
-class VertexSerializer(serializers.Serializer):
+class VertexSerializer(ProjectionMixin, serializers.Serializer):
     name = serializers.CharField()
     endpoints = serializers.ListField(child=serializers.CharField())
 
     def to_representation(self, obj):
-        return {
-            'id': obj.name,
-            'label': obj.name,
-            'endpoints': obj.endpoints,
-            'value': obj.vertex_size,
-        }
+        return self.project(obj, (
+            ('id', lambda obj: obj.name),
+            ('label', lambda obj: obj.name),
+            ('endpoints', lambda obj: obj.endpoints),
+            ('value', lambda obj: obj.vertex_size),
+        ))
 
 
 class PortalSerializer(serializers.Serializer):
@@ -46,17 +68,84 @@ class PortalSerializer(serializers.Serializer):
     edges = serializers.ListField(child=EdgeSerializer())
 
 
+def encode_endpoints(data):
+    """Returns the graph ``data`` with each endpoint listed once, in an
+    ``endpoints`` table. Nodes refer to their endpoints by index, and edges
+    list ``[index, access]`` pairs, followed by ``p50``, ``p95``, ``p99`` and
+    ``error_rate`` for endpoints with latencies."""
+    table = {}
+
+    def index(endpoint):
+        return table.setdefault(endpoint, len(table))
+
+    nodes = [dict(node, endpoints=[index(e) for e in node['endpoints']])
+             if 'endpoints' in node else node for node in data['nodes']]
+
+    def encode(e):
+        encoded = [index(e['endpoint']), e['access']]
+        if 'p50' in e:
+            encoded += [e['p50'], e['p95'], e['p99'], e['error_rate']]
+        return encoded
+
+    edges = [dict(edge, endpoints=[encode(e) for e in edge['endpoints']])
+             if 'endpoints' in edge else edge for edge in data['edges']]
+    encoded = dict(data, nodes=nodes, edges=edges)
+    encoded['endpoints'] = sorted(table, key=table.get)
+    return encoded
+
+
+class MicrodotListSerializer(serializers.ListSerializer):
+    def get_hits(self):
+        hits = Counter()
+        for data in self.validated_data:
+            hits[self.child.get_hit(data)] += data['weight']
+        return hits
+
+    def get_latencies(self):
+        latencies = {}
+        for data in self.validated_data:
+            self.child.add_latency(latencies, data)
+        return latencies
+
+    def save(self, hits=None, latencies=None):
+        if hits is None:
+            hits, latencies = self.get_hits(), self.get_latencies()
+        save_microdots(hits, latencies)
+
+
 class MicrodotSerializer(serializers.Serializer):
     origin = serializers.CharField()
     target = serializers.CharField()
     method = serializers.CharField()
     endpoint = serializers.CharField()
+    weight = serializers.IntegerField(min_value=1, default=1)
+    duration_ms = serializers.FloatField(min_value=0, required=False)
+    status = serializers.IntegerField(min_value=100, max_value=599, required=False)
+
+    class Meta:
+        list_serializer_class = MicrodotListSerializer
+
+    def get_hit(self, data):
+        endpoint = '{method} {uri}'.format(method=data['method'], uri=data['endpoint'])
+        return data['origin'], data['target'], endpoint
+
+    def get_hits(self):
+        return Counter({self.get_hit(self.validated_data): self.validated_data['weight']})
+
+    def get_latencies(self):
+        return self.add_latency({}, self.validated_data)
+
+    def add_latency(self, latencies, data):
+        """Adds the duration and status of ``data``, if any, to the sketch of
+        its hit in ``latencies``."""
+        if data.get('duration_ms') is not None or data.get('status') is not None:
+            sketch = latencies.setdefault(self.get_hit(data), LatencySketch())
+            sketch.add(data.get('duration_ms'), data.get('status'), data['weight'])
+        return latencies
 
-    def save(self):
-        endpoint = '{method} {uri}'.format(method=self.validated_data['method'],
-                                           uri=self.validated_data['endpoint'])
-        origin = Vertex(self.validated_data['origin'])
-        origin.save()
-        target = Vertex(self.validated_data['target'], endpoint)
-        target.save()
-        Edge(origin, target, endpoint).save()
+    def save(self, hits=None, latencies=None):
+        """Saves the microdot, or ``hits`` sampled from it and their
+        ``latencies``."""
+        if hits is None:
+            hits, latencies = self.get_hits(), self.get_latencies()
+        save_microdots(hits, latencies)
@@ -12,8 +12,9 @@ https://docs.djangoproject.com/en/1.8/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
-from py2neo import Graph
-from .backends import RedisBackend
+from .backends import get_backend
+from .instrumentation import instrument
+from .stores import get_graph
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -41,9 +42,11 @@ INSTALLED_APPS = (
     'django.contrib.staticfiles',
     'corsheaders',
     'rest_framework',
+    'api',
 )
 
 MIDDLEWARE_CLASSES = (
+    'api.compression.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,6 +60,27 @@ MIDDLEWARE_CLASSES = (
 
 ROOT_URLCONF = 'api.urls'
 
+# Besides JSON, microdots can be posted and graphs requested as MessagePack.
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': (
+        'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+        'api.renderers.MessagePackRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'rest_framework.parsers.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+        'api.parsers.MessagePackParser',
+    ),
+}
+
+# Responses of at least RESPONSE_COMPRESSION_MIN_SIZE bytes are compressed
+# with brotli, when the brotli package is installed, or gzip, as accepted by
+# the client.
+RESPONSE_COMPRESSION_MIN_SIZE = 1024
+RESPONSE_BROTLI_QUALITY = 5
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -109,10 +133,134 @@ STATIC_ROOT = 'staticfiles'
 
 CORS_ORIGIN_ALLOW_ALL = True
 
+# Stores holding the graph ('neo4j' or 'memory') and the endpoint counters
+# ('redis' or 'memory'). The in-memory ones need no external services and
+# keep their data in the current process only, for tests and benchmarks.
+# Connections are opened on first use, once per process.
+GRAPH_BACKEND = os.environ.get('GRAPH_BACKEND', 'neo4j')
+COUNTER_BACKEND = os.environ.get('COUNTER_BACKEND', 'redis')
+
 NEO4J_URL = os.environ.get('GRAPHENEDB_URL', 'http://localhost:7474/db/data/')
-GRAPH = Graph(NEO4J_URL, bolt=False)
+# Talk to Neo4j over Bolt instead of HTTP.
+NEO4J_BOLT = os.environ.get('NEO4J_BOLT', '0') == '1'
+GRAPH = get_graph(GRAPH_BACKEND, NEO4J_URL, bolt=NEO4J_BOLT)
 REDIS_URL = os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379')
-PERSISTENT_BACKEND = RedisBackend()
+# Size of the Redis connection pool of each process, and seconds to wait for
+# a free connection when all of them are in use.
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 20))
+REDIS_POOL_TIMEOUT = 5
+
+# Independent Neo4j and Redis calls of a request run concurrently, up to this
+# many at once, when the process runs on gevent (see gunicorn_gevent.py).
+CONCURRENT_BACKEND_CALLS = int(os.environ.get('CONCURRENT_BACKEND_CALLS', 8))
 ENDPOINT_ENTRY_TIMEOUT = 120
 
+# Layout of the endpoint hits stored in Redis: 'buckets' keeps one hash of
+# counters per edge every ENDPOINT_BUCKET_SIZE seconds, 'keys' stores one key
+# per hit, and 'migrate' writes buckets while still reading per-hit keys.
+ENDPOINT_STORAGE_LAYOUT = os.environ.get('ENDPOINT_STORAGE_LAYOUT', 'buckets')
+ENDPOINT_BUCKET_SIZE = 10
+PERSISTENT_BACKEND = get_backend(COUNTER_BACKEND, ENDPOINT_STORAGE_LAYOUT)
+
+# Hits are also rolled up per edge and endpoint in each of ROLLUP_TIERS, given
+# as (name, bucket seconds, retention seconds), for GET /graph/?window=. A
+# window is served by the coarsest tier splitting it in at least
+# ROLLUP_MIN_BUCKETS buckets, and can't be longer than GRAPH_MAX_WINDOW.
+ROLLUP_TIERS = (
+    ('minute', 60, 2 * 3600),
+    ('hour', 3600, 2 * 86400),
+    ('day', 86400, 8 * 86400),
+)
+ROLLUP_MIN_BUCKETS = 6
+GRAPH_MAX_WINDOW = 7 * 86400
+
+# Maximum number of hops GET /graph/<service>/?depth= traverses.
+GRAPH_MAX_DEPTH = 5
+
+# Seconds the graph index of the /analytics/ endpoints is kept once the graph
+# changed.
+ANALYTICS_INDEX_TTL = 60
+
+# Maximum number of nodes in a page of GET /graph/?limit=&cursor=.
+GRAPH_MAX_PAGE_SIZE = 1000
+
+# GET /graph/changes/?since= lists the nodes and edges changed since a
+# version, as long as it is at most GRAPH_CHANGES_RETENTION seconds and
+# GRAPH_CHANGELOG_SIZE graph changes old. Older clients get the whole graph.
+# The event stream of /graph/changes/stream/ looks for changes every
+# GRAPH_CHANGES_POLL_INTERVAL seconds, and is closed after
+# GRAPH_CHANGES_STREAM_TIMEOUT seconds, for clients to reconnect.
+GRAPH_CHANGES_RETENTION = 300
+GRAPH_CHANGELOG_SIZE = 1000
+GRAPH_CHANGES_POLL_INTERVAL = 2
+GRAPH_CHANGES_STREAM_TIMEOUT = 60
+
+# Record the latency of every graph store, counter backend and Redis call,
+# exported by /metrics. With METRICS_RESPONSE_HEADER, responses carry the
+# number of backend calls made by the request in X-Backend-Calls.
+INSTRUMENT_BACKENDS = os.environ.get('INSTRUMENT_BACKENDS', '1') == '1'
+METRICS_RESPONSE_HEADER = DEBUG
+if INSTRUMENT_BACKENDS:
+    GRAPH, PERSISTENT_BACKEND = instrument(GRAPH, PERSISTENT_BACKEND)
+
+# Seconds a rendered graph is served from the cache when nothing was written.
+GRAPH_CACHE_TTL = ENDPOINT_BUCKET_SIZE
+
+# Endpoints are normalized before being stored: ids, UUIDs, dates and hashes
+# found in path segments are replaced by placeholders, unless the path matches
+# one of the templates listed for the target service in ENDPOINT_TEMPLATES,
+# e.g. {'users': ['/users/{uuid}/posts/{slug}']}. Once a service has
+# ENDPOINT_MAX_PER_SERVICE endpoints, new ones are counted as '/{other}'.
+ENDPOINT_TEMPLATES = {}
+ENDPOINT_NORMALIZER_CACHE_SIZE = 65536
+ENDPOINT_MAX_PER_SERVICE = 500
+
+# Vertices and edges looked up while storing microdots are cached per process.
+# The TTL must stay below ENDPOINT_ENTRY_TIMEOUT, so a cached edge is always
+# younger than its last hit and can't outlive a removal of stale edges.
+GRAPH_LOOKUP_CACHE_SIZE = 4096
+GRAPH_LOOKUP_CACHE_TTL = 60
+
+# Edges without hits in the last ENDPOINT_ENTRY_TIMEOUT seconds are left out
+# of GET /graph/. Those without hits in the last GRAPH_MAX_WINDOW seconds are
+# removed by `manage.py reap_edges`, run by the single reaper process of the
+# Procfile.
+REAPER_BATCH_SIZE = 500
+# Keys expire all the time, so `reap_edges --listen` waits at least this many
+# seconds between two reaps.
+REAPER_MIN_LISTEN_INTERVAL = 60
+
+# How POST /microdot/ stores hits: 'sync' writes them before answering,
+# 'buffer' aggregates them in memory and writes them from a background thread
+# every MICRODOT_BUFFER_MAX_AGE seconds or MICRODOT_BUFFER_MAX_ENTRIES distinct
+# (origin, target, endpoint) hits, whichever comes first, and 'queue' pushes
+# them to a Redis list drained by `manage.py run_microdot_worker`.
+MICRODOT_INGEST_MODE = os.environ.get('MICRODOT_INGEST_MODE', 'sync')
+MICRODOT_BUFFER_MAX_ENTRIES = 10000
+MICRODOT_BUFFER_MAX_AGE = 5
+MICRODOT_BUFFER_FLUSH_INTERVAL = 1
+MICRODOT_WORKER_BATCH_SIZE = int(os.environ.get('MICRODOT_WORKER_BATCH_SIZE', 500))
+MICRODOT_WORKER_TIMEOUT = 5
+# Events of a batch failing MICRODOT_WORKER_MAX_ATTEMPTS times are moved to the
+# microdots:dead-letter list. Those of a worker which hasn't polled the queue
+# for MICRODOT_WORKER_LEASE seconds are queued again by the running workers,
+# which look for them every MICRODOT_WORKER_RECOVERY_INTERVAL seconds.
+MICRODOT_WORKER_MAX_ATTEMPTS = 5
+MICRODOT_WORKER_LEASE = 300
+MICRODOT_WORKER_RECOVERY_INTERVAL = 60
+
+# `manage.py run_microdot_listener` receives microdots as lines of text on
+# this UDP and TCP port, and stores the hits received every
+# MICRODOT_LISTENER_FLUSH_INTERVAL seconds according to MICRODOT_INGEST_MODE.
+MICRODOT_LISTENER_PORT = int(os.environ.get('MICRODOT_LISTENER_PORT', 8125))
+MICRODOT_LISTENER_FLUSH_INTERVAL = 1
+
+# Once an (origin, target, endpoint) triple had more than
+# MICRODOT_SAMPLING_THRESHOLD hits per second over the previous
+# MICRODOT_SAMPLING_WINDOW seconds, only a fraction of its hits is stored,
+# weighted to keep counts unbiased, and responses carry the sample rate in
+# X-Sample-Rate. Rates are tracked by each process; 0 disables sampling.
+MICRODOT_SAMPLING_THRESHOLD = float(os.environ.get('MICRODOT_SAMPLING_THRESHOLD', 0))
+MICRODOT_SAMPLING_WINDOW = 10
+
 NODE_SIZE = (5, 400)
@@ -0,0 +1,115 @@
+from collections import Counter
+import math
+
+# Durations are counted in buckets growing by GAMMA from 1 ms, which bounds
+# the relative error of quantiles to (GAMMA - 1) / (GAMMA + 1), about 5%.
+# Longer durations than the last bucket, about 70 minutes, are counted in it,
+# so a sketch never holds more than BUCKETS + 2 counters.
+GAMMA = 1.1
+BUCKETS = 160
+ERRORS_FIELD = 'e'
+STATUSES_FIELD = 's'
+
+
+def bucket_index(duration_ms):
+    if duration_ms <= 1:
+        return 0
+    return min(BUCKETS, int(math.ceil(math.log(duration_ms) / math.log(GAMMA))))
+
+
+def bucket_value(index):
+    """Returns the duration in the middle of bucket ``index``, relative
+    error wise."""
+    return 2 * GAMMA ** index / (GAMMA + 1)
+
+
+class LatencySketch(object):
+    """Fixed-size, mergeable summary of the durations and statuses of the
+    requests to an endpoint. Statuses of 500 and above count as errors."""
+
+    def __init__(self, buckets=None, errors=0, statuses=0):
+        self.buckets = Counter(buckets or {})
+        self.errors = errors
+        self.statuses = statuses
+
+    def add(self, duration_ms=None, status=None, count=1):
+        if duration_ms is not None:
+            self.buckets[bucket_index(duration_ms)] += count
+        if status is not None:
+            self.statuses += count
+            if status >= 500:
+                self.errors += count
+
+    def merge(self, other):
+        self.buckets.update(other.buckets)
+        self.errors += other.errors
+        self.statuses += other.statuses
+        return self
+
+    def __bool__(self):
+        return bool(self.statuses or self.count)
+
+    def __eq__(self, other):
+        return isinstance(other, LatencySketch) and self.to_fields() == other.to_fields()
+
+    @property
+    def count(self):
+        return sum(self.buckets.values())
+
+    def quantile(self, q):
+        """Estimates the ``q`` quantile of the durations, in milliseconds, as
+        the nearest-rank duration."""
+        count = self.count
+        if not count:
+            return None
+        rank = max(1, math.ceil(q * count))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return round(bucket_value(index), 2)
+
+    def error_rate(self):
+        if not self.statuses:
+            return None
+        return self.errors / self.statuses
+
+    def summary(self):
+        return {
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'error_rate': self.error_rate(),
+        }
+
+    def to_fields(self):
+        """Returns the non-zero counters of the sketch by field name, as kept
+        in Redis hashes and queued events."""
+        fields = {'d{}'.format(index): count for index, count in self.buckets.items() if count}
+        if self.statuses:
+            fields[ERRORS_FIELD] = self.errors
+            fields[STATUSES_FIELD] = self.statuses
+        return fields
+
+    @classmethod
+    def from_fields(cls, fields):
+        sketch = cls()
+        for field, count in fields.items():
+            sketch.add_field(field, int(count))
+        return sketch
+
+    def add_field(self, field, count):
+        if field == ERRORS_FIELD:
+            self.errors += count
+        elif field == STATUSES_FIELD:
+            self.statuses += count
+        else:
+            self.buckets[int(field[1:])] += count
+
+
+def merge_sketches(sketches, key, sketch):
+    """Merges ``sketch`` into ``sketches[key]``."""
+    if key in sketches:
+        sketches[key].merge(sketch)
+    else:
+        sketches[key] = LatencySketch().merge(sketch)
@@ -0,0 +1,495 @@
+from collections import defaultdict
+import itertools
+import re
+import threading
+
+from py2neo import Graph, Node, Relationship
+
+from .connections import ProcessLocal
+
+
+class GraphStore(object):
+    """Graph database operations used by ``Vertex``, ``Edge`` and
+    ``GraphReader``.
+
+    Entities are py2neo ``Node`` and ``Relationship`` objects. Besides the
+    py2neo ``Graph`` methods, stores provide bulk reads returning plain rows,
+    so a whole graph can be loaded with a fixed number of calls.
+    """
+
+    def find(self, label, property_key=None, property_value=None):
+        raise NotImplementedError
+
+    def find_one(self, label, property_key=None, property_value=None):
+        raise NotImplementedError
+
+    def match(self, start_node=None, rel_type=None, end_node=None):
+        raise NotImplementedError
+
+    def match_one(self, start_node=None, rel_type=None, end_node=None):
+        raise NotImplementedError
+
+    def exists(self, subgraph):
+        raise NotImplementedError
+
+    def create(self, subgraph):
+        raise NotImplementedError
+
+    def push(self, subgraph):
+        raise NotImplementedError
+
+    def pull(self, subgraph):
+        raise NotImplementedError
+
+    def separate(self, relationship):
+        raise NotImplementedError
+
+    def delete_all(self):
+        raise NotImplementedError
+
+    def vertex_rows(self, label, rel_type, prefix=None, pattern=None, after=None, limit=None):
+        """Returns a dict with the ``name``, ``endpoints`` and number of
+        ``dependents`` of every node with ``label``.
+
+        Nodes can be restricted to names starting with ``prefix`` or matching
+        the regular expression ``pattern`` as a whole. With ``limit``, at most
+        that many nodes are returned, sorted by name, starting after the name
+        ``after``.
+        """
+        raise NotImplementedError
+
+    def edge_rows(self, label, rel_type, prefix=None, pattern=None, after=None, limit=None):
+        """Returns a dict with the ``id``, ``name``, ``origin``,
+        ``origin_endpoints``, ``target`` and ``target_endpoints`` of every
+        ``rel_type`` relationship between ``label`` nodes.
+
+        Both nodes must match ``prefix`` and ``pattern``, and the origin must
+        be one of the nodes ``vertex_rows`` returns for ``after`` and
+        ``limit``.
+        """
+        raise NotImplementedError
+
+    def vertex_stats(self, label, rel_type, prefix=None, pattern=None):
+        """Returns the ``count`` of ``label`` nodes matching ``prefix`` and
+        ``pattern``, and the ``min_dependents`` and ``max_dependents`` of one
+        of them."""
+        raise NotImplementedError
+
+    def subgraph_rows(self, label, rel_type, name, depth, direction):
+        """Returns the rows of the ``label`` nodes up to ``depth`` ``rel_type``
+        relationships away from the one named ``name``, following them ``in``,
+        ``out`` or ``both`` ways, and of the relationships between them.
+
+        Nodes rows have the ``name`` and ``endpoints`` of each node, and
+        relationship rows the same keys as ``edge_rows``. Both are empty when
+        there is no such node.
+        """
+        raise NotImplementedError
+
+    def named_rows(self, label, rel_type, names, pairs):
+        """Returns the rows of the ``label`` nodes named in ``names``, as
+        ``vertex_rows`` does, and of the ``rel_type`` relationships between
+        the ``(origin, target)`` names of ``pairs``, as ``edge_rows`` does.
+        Missing nodes and relationships are left out."""
+        raise NotImplementedError
+
+    def delete_relationships(self, rel_type, ids):
+        raise NotImplementedError
+
+    def delete_orphan_vertices(self, label, rel_type):
+        """Deletes the ``label`` nodes without endpoints nor relationships,
+        returning their names."""
+        raise NotImplementedError
+
+
+def name_matches(name, prefix=None, pattern=None):
+    return ((prefix is None or name.startswith(prefix)) and
+            (pattern is None or re.fullmatch(pattern, name) is not None))
+
+
+class Neo4jStore(GraphStore):
+    VERTICES_QUERY = (
+        'MATCH (v:{label}) {where}{page}'
+        'OPTIONAL MATCH ()-[d:{type}]->(v) '
+        'RETURN v.name AS name, v.endpoints AS endpoints, count(d) AS dependents{order}'
+    )
+    EDGES_QUERY = (
+        'MATCH (o:{label}) {where}{page}'
+        'MATCH (o)-[r:{type}]->(t:{label}) {target_where}'
+        'RETURN id(r) AS id, r.name AS name, o.name AS origin, '
+        'o.endpoints AS origin_endpoints, t.name AS target, t.endpoints AS target_endpoints'
+    )
+    VERTEX_STATS_QUERY = (
+        'MATCH (v:{label}) {where}'
+        'OPTIONAL MATCH ()-[d:{type}]->(v) '
+        'WITH v, count(d) AS dependents '
+        'RETURN count(v) AS count, min(dependents) AS min_dependents, '
+        'max(dependents) AS max_dependents'
+    )
+    START_QUERY = (
+        'MATCH (v:{label} {{name: {{name}}}}) '
+        'RETURN v.name AS name, v.endpoints AS endpoints'
+    )
+    NEIGHBORS_QUERY = (
+        'MATCH (s:{label}) WHERE s.name IN {{frontier}} '
+        'MATCH (s){left}-[:{type}]-{right}(v:{label}) WHERE NOT v.name IN {{seen}} '
+        'RETURN DISTINCT v.name AS name, v.endpoints AS endpoints'
+    )
+    SUBGRAPH_EDGES_QUERY = (
+        'MATCH (o:{label}) WHERE o.name IN {{names}} '
+        'MATCH (o)-[r:{type}]->(t:{label}) WHERE t.name IN {{names}} '
+        'RETURN id(r) AS id, r.name AS name, o.name AS origin, '
+        'o.endpoints AS origin_endpoints, t.name AS target, t.endpoints AS target_endpoints'
+    )
+    PAIRS_EDGES_QUERY = (
+        'UNWIND {{pairs}} AS pair '
+        'MATCH (o:{label} {{name: pair[0]}})-[r:{type}]->(t:{label} {{name: pair[1]}}) '
+        'RETURN id(r) AS id, r.name AS name, o.name AS origin, '
+        'o.endpoints AS origin_endpoints, t.name AS target, t.endpoints AS target_endpoints'
+    )
+    DIRECTIONS = {'in': ('<', ''), 'out': ('', '>'), 'both': ('', '')}
+    DELETE_RELATIONSHIPS_QUERY = 'MATCH ()-[r:{type}]->() WHERE id(r) IN {{ids}} DELETE r'
+    DELETE_ORPHANS_QUERY = (
+        'MATCH (v:{label}) WHERE NOT (v)-[:{type}]-() '
+        'AND (v.endpoints IS NULL OR size(v.endpoints) = 0) '
+        'WITH v, v.name AS name DELETE v RETURN name'
+    )
+
+    def __init__(self, url, bolt=False):
+        self.connection = ProcessLocal(lambda: Graph(url, bolt=bolt))
+
+    @property
+    def graph(self):
+        return self.connection.get()
+
+    def find(self, label, property_key=None, property_value=None):
+        return self.graph.find(label, property_key=property_key, property_value=property_value)
+
+    def find_one(self, label, property_key=None, property_value=None):
+        return self.graph.find_one(label, property_key=property_key,
+                                   property_value=property_value)
+
+    def match(self, start_node=None, rel_type=None, end_node=None):
+        return self.graph.match(start_node=start_node, rel_type=rel_type, end_node=end_node)
+
+    def match_one(self, start_node=None, rel_type=None, end_node=None):
+        return self.graph.match_one(start_node=start_node, rel_type=rel_type,
+                                    end_node=end_node)
+
+    def exists(self, subgraph):
+        return self.graph.exists(subgraph)
+
+    def create(self, subgraph):
+        self.graph.create(subgraph)
+
+    def push(self, subgraph):
+        self.graph.push(subgraph)
+
+    def pull(self, subgraph):
+        self.graph.pull(subgraph)
+
+    def separate(self, relationship):
+        self.graph.separate(relationship)
+
+    def delete_all(self):
+        self.graph.delete_all()
+
+    def run(self, statement, **parameters):
+        return [dict(record) for record in self.graph.run(statement, **parameters)]
+
+    @staticmethod
+    def where(variable, prefix=None, pattern=None, after=None):
+        """Returns the WHERE clause filtering the names of ``variable``."""
+        conditions = []
+        if prefix is not None:
+            conditions.append('{}.name STARTS WITH {{prefix}}'.format(variable))
+        if pattern is not None:
+            conditions.append('{}.name =~ {{pattern}}'.format(variable))
+        if after is not None:
+            conditions.append('{}.name > {{after}}'.format(variable))
+        if not conditions:
+            return ''
+        return 'WHERE {} '.format(' AND '.join(conditions))
+
+    @staticmethod
+    def page(variable, limit=None):
+        if limit is None:
+            return ''
+        return 'WITH {0} ORDER BY {0}.name LIMIT {1} '.format(variable, int(limit))
+
+    def vertex_rows(self, label, rel_type, prefix=None, pattern=None, after=None, limit=None):
+        statement = self.VERTICES_QUERY.format(
+            label=label, type=rel_type, where=self.where('v', prefix, pattern, after),
+            page=self.page('v', limit), order=' ORDER BY name' if limit is not None else '')
+        return self.run(statement, prefix=prefix, pattern=pattern, after=after)
+
+    def edge_rows(self, label, rel_type, prefix=None, pattern=None, after=None, limit=None):
+        statement = self.EDGES_QUERY.format(
+            label=label, type=rel_type, where=self.where('o', prefix, pattern, after),
+            page=self.page('o', limit), target_where=self.where('t', prefix, pattern))
+        return self.run(statement, prefix=prefix, pattern=pattern, after=after)
+
+    def vertex_stats(self, label, rel_type, prefix=None, pattern=None):
+        statement = self.VERTEX_STATS_QUERY.format(label=label, type=rel_type,
+                                                   where=self.where('v', prefix, pattern))
+        return self.run(statement, prefix=prefix, pattern=pattern)[0]
+
+    def subgraph_rows(self, label, rel_type, name, depth, direction):
+        # Expands one hop per query, as a variable length pattern enumerates
+        # every path up to ``depth`` rather than every vertex.
+        left, right = self.DIRECTIONS[direction]
+        vertices = self.run(self.START_QUERY.format(label=label), name=name)
+        if not vertices:
+            return [], []
+        names = [row['name'] for row in vertices]
+        frontier = names
+        statement = self.NEIGHBORS_QUERY.format(label=label, type=rel_type,
+                                                left=left, right=right)
+        for _ in range(int(depth)):
+            reached = self.run(statement, frontier=frontier, seen=names)
+            if not reached:
+                break
+            vertices.extend(reached)
+            frontier = [row['name'] for row in reached]
+            names = names + frontier
+        edges = self.run(self.SUBGRAPH_EDGES_QUERY.format(label=label, type=rel_type),
+                         names=names)
+        return vertices, edges
+
+    def named_rows(self, label, rel_type, names, pairs):
+        vertices = edges = []
+        if names:
+            vertices = self.run(self.VERTICES_QUERY.format(
+                label=label, type=rel_type, where='WHERE v.name IN {names} ', page='', order=''),
+                names=list(names))
+        if pairs:
+            edges = self.run(self.PAIRS_EDGES_QUERY.format(label=label, type=rel_type),
+                             pairs=[list(pair) for pair in pairs])
+        return vertices, edges
+
+    def delete_relationships(self, rel_type, ids):
+        if ids:
+            self.run(self.DELETE_RELATIONSHIPS_QUERY.format(type=rel_type), ids=list(ids))
+
+    def delete_orphan_vertices(self, label, rel_type):
+        rows = self.run(self.DELETE_ORPHANS_QUERY.format(label=label, type=rel_type))
+        return [row['name'] for row in rows]
+
+
+class MemoryGraph(GraphStore):
+    """Keeps the graph in process memory, for tests and benchmarks.
+
+    Nodes are indexed by label and ``name``, and relationships by their start
+    and end nodes, so lookups don't depend on the size of the graph.
+    ``push`` and ``pull`` do nothing, as the stored entities are the objects
+    themselves.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.delete_all()
+
+    def delete_all(self):
+        with self.lock:
+            self.nodes = {}
+            self.names = {}
+            self.relationships = {}
+            self.relationship_ids = {}
+            self.outgoing = defaultdict(dict)
+            self.incoming = defaultdict(dict)
+            self.ids = itertools.count()
+
+    def find(self, label, property_key=None, property_value=None):
+        with self.lock:
+            if property_key == 'name':
+                node = self.names.get((label, property_value))
+                nodes = [node] if node is not None else []
+            else:
+                nodes = [n for n in self.nodes.values() if n.has_label(label)]
+        return [n for n in nodes if property_key is None or n[property_key] == property_value]
+
+    def find_one(self, label, property_key=None, property_value=None):
+        return next(iter(self.find(label, property_key, property_value)), None)
+
+    def match(self, start_node=None, rel_type=None, end_node=None):
+        with self.lock:
+            if start_node is not None:
+                candidates = self.outgoing.get(id(start_node), {}).values()
+            elif end_node is not None:
+                candidates = self.incoming.get(id(end_node), {}).values()
+            else:
+                candidates = self.relationships.values()
+            return [r for r in candidates
+                    if (rel_type is None or r.type() == rel_type) and
+                    (end_node is None or r.end_node() is end_node)]
+
+    def match_one(self, start_node=None, rel_type=None, end_node=None):
+        return next(iter(self.match(start_node, rel_type, end_node)), None)
+
+    def exists(self, subgraph):
+        with self.lock:
+            if isinstance(subgraph, Relationship):
+                return id(subgraph) in self.relationship_ids
+            return id(subgraph) in self.nodes
+
+    def create(self, subgraph):
+        with self.lock:
+            if isinstance(subgraph, Node):
+                self.add_node(subgraph)
+                return
+            self.add_node(subgraph.start_node())
+            self.add_node(subgraph.end_node())
+            if id(subgraph) not in self.relationship_ids:
+                rel_id = next(self.ids)
+                self.relationships[rel_id] = subgraph
+                self.relationship_ids[id(subgraph)] = rel_id
+                self.outgoing[id(subgraph.start_node())][rel_id] = subgraph
+                self.incoming[id(subgraph.end_node())][rel_id] = subgraph
+
+    def add_node(self, node):
+        if id(node) in self.nodes:
+            return
+        self.nodes[id(node)] = node
+        for label in node.labels():
+            self.names.setdefault((label, node['name']), node)
+
+    def push(self, subgraph):
+        pass
+
+    def pull(self, subgraph):
+        pass
+
+    def separate(self, relationship):
+        with self.lock:
+            rel_id = self.relationship_ids.pop(id(relationship), None)
+            if rel_id is None:
+                return
+            del self.relationships[rel_id]
+            self.outgoing[id(relationship.start_node())].pop(rel_id, None)
+            self.incoming[id(relationship.end_node())].pop(rel_id, None)
+
+    def select(self, label, prefix=None, pattern=None, after=None, limit=None):
+        nodes = [node for node in self.nodes.values()
+                 if node.has_label(label) and name_matches(node['name'], prefix, pattern) and
+                 (after is None or node['name'] > after)]
+        if limit is not None:
+            nodes = sorted(nodes, key=lambda node: node['name'])[:limit]
+        return nodes
+
+    def dependents(self, node, rel_type):
+        return sum(1 for r in self.incoming.get(id(node), {}).values() if r.type() == rel_type)
+
+    def vertex_rows(self, label, rel_type, prefix=None, pattern=None, after=None, limit=None):
+        with self.lock:
+            return [{'name': node['name'],
+                     'endpoints': node['endpoints'],
+                     'dependents': self.dependents(node, rel_type)}
+                    for node in self.select(label, prefix, pattern, after, limit)]
+
+    def edge_rows(self, label, rel_type, prefix=None, pattern=None, after=None, limit=None):
+        with self.lock:
+            return [{'id': rel_id,
+                     'name': r['name'],
+                     'origin': node['name'],
+                     'origin_endpoints': node['endpoints'],
+                     'target': r.end_node()['name'],
+                     'target_endpoints': r.end_node()['endpoints']}
+                    for node in self.select(label, prefix, pattern, after, limit)
+                    for rel_id, r in self.outgoing.get(id(node), {}).items()
+                    if r.type() == rel_type and r.end_node().has_label(label) and
+                    name_matches(r.end_node()['name'], prefix, pattern)]
+
+    def vertex_stats(self, label, rel_type, prefix=None, pattern=None):
+        with self.lock:
+            dependents = [self.dependents(node, rel_type)
+                          for node in self.select(label, prefix, pattern)]
+            return {'count': len(dependents),
+                    'min_dependents': min(dependents, default=None),
+                    'max_dependents': max(dependents, default=None)}
+
+    def subgraph_rows(self, label, rel_type, name, depth, direction):
+        with self.lock:
+            start = self.names.get((label, name))
+            if start is None:
+                return [], []
+            found = {id(start): start}
+            frontier = [start]
+            for _ in range(depth):
+                reached = []
+                for node in frontier:
+                    for other in self.neighbors(node, rel_type, direction):
+                        if id(other) not in found and other.has_label(label):
+                            found[id(other)] = other
+                            reached.append(other)
+                frontier = reached
+
+            vertices = [{'name': n['name'], 'endpoints': n['endpoints']}
+                        for n in found.values()]
+            edges = [{'id': rel_id,
+                      'name': r['name'],
+                      'origin': node['name'],
+                      'origin_endpoints': node['endpoints'],
+                      'target': r.end_node()['name'],
+                      'target_endpoints': r.end_node()['endpoints']}
+                     for node in found.values()
+                     for rel_id, r in self.outgoing.get(id(node), {}).items()
+                     if r.type() == rel_type and id(r.end_node()) in found]
+            return vertices, edges
+
+    def neighbors(self, node, rel_type, direction):
+        if direction in ('out', 'both'):
+            for r in self.outgoing.get(id(node), {}).values():
+                if r.type() == rel_type:
+                    yield r.end_node()
+        if direction in ('in', 'both'):
+            for r in self.incoming.get(id(node), {}).values():
+                if r.type() == rel_type:
+                    yield r.start_node()
+
+    def named_rows(self, label, rel_type, names, pairs):
+        with self.lock:
+            nodes = [self.names.get((label, name)) for name in names]
+            vertices = [{'name': node['name'],
+                         'endpoints': node['endpoints'],
+                         'dependents': self.dependents(node, rel_type)}
+                        for node in nodes if node is not None]
+            edges = []
+            for origin, target in pairs:
+                node = self.names.get((label, origin))
+                edges.extend({'id': rel_id,
+                              'name': r['name'],
+                              'origin': origin,
+                              'origin_endpoints': node['endpoints'],
+                              'target': target,
+                              'target_endpoints': r.end_node()['endpoints']}
+                             for rel_id, r in self.outgoing.get(id(node), {}).items()
+                             if r.type() == rel_type and r.end_node().has_label(label) and
+                             r.end_node()['name'] == target)
+            return vertices, edges
+
+    def delete_relationships(self, rel_type, ids):
+        with self.lock:
+            for rel_id in ids:
+                relationship = self.relationships.get(rel_id)
+                if relationship is not None:
+                    self.separate(relationship)
+
+    def delete_orphan_vertices(self, label, rel_type):
+        with self.lock:
+            orphans = [node for node in self.nodes.values()
+                       if node.has_label(label) and not node['endpoints'] and
+                       not self.outgoing.get(id(node)) and not self.incoming.get(id(node))]
+            for node in orphans:
+                del self.nodes[id(node)]
+                for node_label in node.labels():
+                    if self.names.get((node_label, node['name'])) is node:
+                        del self.names[node_label, node['name']]
+            return [node['name'] for node in orphans]
+
+
+def get_graph(name, url, bolt=False):
+    if name == 'neo4j':
+        return Neo4jStore(url, bolt=bolt)
+    if name == 'memory':
+        return MemoryGraph()
+    raise ValueError('Unknown graph backend: {}'.format(name))
@@ -1,9 +1,33 @@
+from collections import Counter
+import asyncio
+import gzip
 import json
-from unittest import TestCase
+import random
+import threading
+import time
+from unittest import TestCase, mock, skipIf, skipUnless
 
 from django.conf import settings
+from django.test import override_settings
+import msgpack
+from py2neo import Node, Relationship
 from rest_framework.test import APIClient
-from .models import Edge, Vertex
+from . import bench, sketches
+from .analytics import AdjacencyIndex, analytics_index
+from .backends import BucketedRedisBackend, MemoryBackend, RedisBackend, rollup_tier
+from .buffer import AggregationBuffer
+from .cache import LRUCache, etag_matches, graph_cache, variant_etag
+from .concurrency import concurrently
+from .connections import ProcessLocal
+from .instrumentation import InstrumentedProxy, MetricsRegistry, metrics
+from .listener import MicrodotListener, StreamProtocol, parse_line
+from .models import (BaseGraph, Edge, GraphReader, Vertex, edge_cache, endpoint_usages,
+                     vertex_cache, vertex_sizes)
+from .normalizer import EndpointNormalizer
+from .reaper import Reaper
+from .sampling import AdaptiveSampler, sampler
+from .sketches import LatencySketch
+from .stores import MemoryGraph
 
 
 class GraphTestCase(TestCase):
@@ -16,6 +40,11 @@ class GraphTestCase(TestCase):
         super().tearDown()
         self.graph.delete_all()
         self.backend.flush_db()
+        graph_cache.clear()
+        vertex_cache.clear()
+        edge_cache.clear()
+        analytics_index.clear()
+        sampler.clear()
 
 
 class VertexTestCase(GraphTestCase):
@@ -48,6 +77,27 @@ class VertexTestCase(GraphTestCase):
         vertex.save()
         self.assertTrue(self.graph.exists(vertex.node))
 
+    def test_vertex_lookup_is_cached(self):
+        Vertex('name').save()
+        with mock.patch.object(self.graph, 'find_one') as find_one:
+            Vertex('name')
+        self.assertFalse(find_one.called)
+
+    def test_save_unchanged_vertex_skips_push(self):
+        Vertex('name', '/usr/test').save()
+        with mock.patch.object(self.graph, 'push') as push:
+            self.assertFalse(Vertex('name', '/usr/test').save())
+        self.assertFalse(push.called)
+
+    def test_save_keeps_endpoints_added_elsewhere(self):
+        vertex = Vertex('name', '/usr/test')
+        vertex.save()
+        vertex_cache.clear()
+        Vertex('name', '/usr/test2').save()
+        vertex.add_endpoint('/usr/test3')
+        vertex.save()
+        self.assertEqual(3, len(Vertex('name').endpoints))
+
     def test_vertex_without_name(self):
         with self.assertRaises(TypeError):
             Vertex()
@@ -102,6 +152,19 @@ class EdgeTestCase(BaseEdgeTestCase):
         edge2.save()
         self.assertEqual(edge.name, edge2.name)
 
+    def test_edge_lookup_is_cached(self):
+        Edge(self.origin, self.target, 'GET /test/').save()
+        with mock.patch.object(self.graph, 'match_one') as match_one:
+            edge = Edge(self.origin, self.target, 'GET /test/')
+        self.assertFalse(match_one.called)
+        self.assertFalse(edge.save())
+
+    def test_delete_invalidates_edge(self):
+        edge = Edge(self.origin, self.target, 'GET /test/')
+        edge.save()
+        edge.delete()
+        self.assertTrue(Edge(self.origin, self.target).created)
+
     def test_format_endpoint(self):
         endpoint = 'GET /test/3'
         edge = Edge(self.origin, self.target, endpoint)
@@ -122,6 +185,11 @@ class EdgeTestCase(BaseEdgeTestCase):
         edge = Edge(self.origin, self.target, endpoint)
         self.assertEqual('GET /test/{id}', edge.format_endpoint(endpoint))
 
+    def test_format_endpoint_with_uuid(self):
+        endpoint = 'GET /test/123e4567-e89b-12d3-a456-426614174000/'
+        edge = Edge(self.origin, self.target, endpoint)
+        self.assertEqual('GET /test/{uuid}/', edge.format_endpoint(endpoint))
+
     def test_request_count(self):
         endpoint = 'GET /test/3'
         Edge(self.origin, self.target, endpoint).save()
@@ -143,6 +211,59 @@ class EdgeTestCase(BaseEdgeTestCase):
         self.assertEqual(endpoints['GET /test/'], 2)
 
 
+class GraphReaderTestCase(BaseEdgeTestCase):
+    def setUp(self):
+        super().setUp()
+        Edge(self.origin, self.target, 'GET /usr/test2').save()
+        self.reader = GraphReader()
+
+    def test_load_vertices_with_dependents(self):
+        vertices = {v.name: v for v in self.reader.load_vertices()}
+        self.assertEqual(0, vertices['origin'].dependents_number)
+        self.assertEqual(1, vertices['target'].dependents_number)
+        self.assertEqual({'/usr/test2'}, vertices['target'].endpoints)
+
+    def test_load_edges_shares_vertices(self):
+        vertices = self.reader.load_vertices()
+        edges = self.reader.load_edges(vertices)
+        self.assertEqual(['origin-target'], [e.name for e in edges])
+        self.assertIn(edges[0].target, vertices)
+
+    def test_load_subgraph(self):
+        other = Vertex('other')
+        other.save()
+        Edge(other, self.origin).save()
+        vertices, edges = self.reader.load_subgraph('target', 1, 'in')
+        self.assertEqual({'origin', 'target'}, {v.name for v in vertices})
+        self.assertEqual(['origin-target'], [e.name for e in edges])
+        vertices, edges = self.reader.load_subgraph('target', 2, 'in')
+        self.assertEqual(2, len(edges))
+        self.assertEqual(1, {v.name: v for v in vertices}['origin'].dependents_number)
+        vertices, edges = self.reader.load_subgraph('target', 2, 'out')
+        self.assertEqual((['target'], []), ([v.name for v in vertices], edges))
+        self.assertEqual(([], []), self.reader.load_subgraph('unknown', 1, 'both'))
+
+    def test_delete_edges(self):
+        self.reader.delete_edges(self.reader.load_edges(self.reader.load_vertices()))
+        self.assertEqual(0, self.target.dependents_number)
+
+
+class ReaperTestCase(BaseEdgeTestCase):
+    def test_reap_stale_edges(self):
+        Edge(self.origin, self.target, 'GET /test/').save()
+        other = Vertex('other')
+        other.save()
+        Edge(other, self.target).save()
+        self.assertEqual((1, 0), Reaper(batch_size=1).reap())
+        self.assertEqual(1, self.target.dependents_number)
+
+    def test_reap_orphan_vertices(self):
+        Vertex('lonely').save()
+        self.assertEqual((0, 2), Reaper().reap(vertices=True))
+        self.assertTrue(Vertex('lonely').created)
+        self.assertFalse(Vertex('target').created)
+
+
 class ApiTestCase(GraphTestCase):
     def setUp(self):
         super().setUp()
@@ -158,6 +279,18 @@ class ApiTestCase(GraphTestCase):
         request = self.client.post('/microdot/', self.data)
         self.assertEqual(201, request.status_code)
 
+    def test_post_microdot_to_itself(self):
+        data = dict(self.data, target='origin-requester')
+        self.assertEqual(201, self.client.post('/microdot/', data).status_code)
+        content = self.client.get('/graph/').data
+        self.assertEqual(['origin-requester'], [n['id'] for n in content['nodes']])
+
+    def test_get_service_graph_named_like_a_route(self):
+        for name in ('user-microdot', 'graph-store'):
+            Vertex(name, 'GET /test/').save()
+            content = self.client.get('/graph/{}/'.format(name)).data
+            self.assertEqual([name], [n['id'] for n in content['nodes']])
+
     def test_get_graph_json(self):
         origin = Vertex('origin')
         origin.save()
@@ -168,6 +301,22 @@ class ApiTestCase(GraphTestCase):
         request = self.client.get('/graph/')
         self.assertEqual(200, request.status_code)
 
+    def test_get_service_graph(self):
+        origin = Vertex('origin')
+        origin.save()
+        target = Vertex('target', 'GET /test/3/')
+        target.save()
+        other = Vertex('other', 'GET /foo/')
+        other.save()
+        Edge(origin, target, 'GET /test/3/').save()
+        Edge(target, other, 'GET /foo/').save()
+        request = self.client.get('/graph/origin/', {'depth': 1, 'direction': 'out'})
+        content = json.loads(request.content.decode('utf-8'))
+        self.assertEqual({'origin', 'target'}, {n['id'] for n in content['nodes']})
+        self.assertEqual(['origin-target'], [e['id'] for e in content['edges']])
+        self.assertEqual(404, self.client.get('/graph/unknown/').status_code)
+        self.assertEqual(400, self.client.get('/graph/origin/', {'depth': 0}).status_code)
+
     def test_get_graph_json_partial_usage(self):
         origin = Vertex('origin')
         origin.save()
@@ -193,6 +342,399 @@ class ApiTestCase(GraphTestCase):
         request = self.client.get('/graph/')
         content = json.loads(request.content.decode('utf-8'))
         self.assertFalse(content['edges'])
+        self.assertTrue(self.graph.exists(edge.relationship))
+
+
+class BatchApiTestCase(GraphTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.data = [
+            {'origin': 'origin', 'target': 'target', 'method': 'GET', 'endpoint': '/test/1'},
+            {'origin': 'origin', 'target': 'target', 'method': 'GET', 'endpoint': '/test/2'},
+            {'origin': 'origin', 'target': 'other', 'method': 'POST', 'endpoint': '/foo/'},
+        ]
+
+    def test_post_json_batch(self):
+        request = self.client.post('/microdot/batch/', self.data, format='json')
+        self.assertEqual(201, request.status_code)
+        endpoints = Edge(Vertex('origin'), Vertex('target')).load_endpoints()
+        self.assertEqual(endpoints['GET /test/{id}'], 2)
+
+    def test_post_json_lines_batch(self):
+        body = '\n'.join(json.dumps(item) for item in self.data)
+        request = self.client.post('/microdot/batch/', body,
+                                   content_type='application/x-ndjson')
+        self.assertEqual(201, request.status_code)
+        self.assertEqual({'POST /foo/'}, Vertex('other').endpoints)
+
+    def test_post_invalid_batch(self):
+        request = self.client.post('/microdot/batch/', self.data[0], format='json')
+        self.assertEqual(400, request.status_code)
+
+
+class GraphFilterTestCase(GraphTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        data = [
+            {'origin': 'payments', 'target': 'pay-gateway', 'method': 'GET', 'endpoint': '/a'},
+            {'origin': 'payments', 'target': 'pay-gateway', 'method': 'GET', 'endpoint': '/b'},
+            {'origin': 'users', 'target': 'payments', 'method': 'GET', 'endpoint': '/c'},
+        ]
+        self.client.post('/microdot/batch/', data, format='json')
+
+    def get_graph(self, **params):
+        return json.loads(self.client.get('/graph/', params).content.decode('utf-8'))
+
+    def test_filter_names(self):
+        content = self.get_graph(prefix='pay')
+        self.assertEqual({'payments', 'pay-gateway'}, {n['id'] for n in content['nodes']})
+        self.assertEqual(['payments-pay-gateway'], [e['id'] for e in content['edges']])
+        content = self.get_graph(match='u.*')
+        self.assertEqual((['users'], []), ([n['id'] for n in content['nodes']], content['edges']))
+        self.assertEqual(400, self.client.get('/graph/', {'match': '('}).status_code)
+
+    def test_filter_edges(self):
+        content = self.get_graph(min_access=2)
+        self.assertEqual(['payments-pay-gateway'], [e['id'] for e in content['edges']])
+        content = self.get_graph(min_usage=100)
+        self.assertEqual(2, len(content['edges']))
+
+    def test_fields(self):
+        content = self.get_graph(fields='from,to')
+        self.assertEqual({'id', 'from', 'to'}, set(content['edges'][0]))
+        self.assertEqual({'id'}, set(content['nodes'][0]))
+        self.assertEqual(400, self.client.get('/graph/', {'fields': 'foo'}).status_code)
+
+    def test_pagination(self):
+        content = self.get_graph(limit=2)
+        self.assertEqual(['pay-gateway', 'payments'], [n['id'] for n in content['nodes']])
+        self.assertEqual(['payments-pay-gateway'], [e['id'] for e in content['edges']])
+        content = self.get_graph(limit=2, cursor=content['next'])
+        self.assertEqual(['users'], [n['id'] for n in content['nodes']])
+        self.assertEqual(['users-payments'], [e['id'] for e in content['edges']])
+        self.assertIsNone(content['next'])
+
+
+class WireFormatTestCase(GraphTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.data = {'origin': 'origin', 'target': 'target', 'method': 'GET', 'endpoint': '/test/'}
+
+    def post_msgpack(self, path, data):
+        return self.client.post(path, msgpack.packb(data, use_bin_type=True),
+                                content_type='application/msgpack')
+
+    def test_msgpack(self):
+        self.assertEqual(201, self.post_msgpack('/microdot/', self.data).status_code)
+        self.assertEqual(201, self.post_msgpack('/microdot/batch/', [self.data]).status_code)
+        request = self.client.get('/graph/', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual('application/msgpack', request['Content-Type'])
+        content = msgpack.unpackb(request.content, encoding='utf-8')
+        self.assertEqual({'GET /test/': 2}, {e['endpoint']: e['access']
+                                             for e in content['edges'][0]['endpoints']})
+
+    def test_dictionary_encoding(self):
+        self.client.post('/microdot/', self.data)
+        request = self.client.get('/graph/', {'encoding': 'dictionary'})
+        content = json.loads(request.content.decode('utf-8'))
+        self.assertEqual(['GET /test/'], content['endpoints'])
+        self.assertEqual([[0, 1]], content['edges'][0]['endpoints'])
+        self.assertEqual(400, self.client.get('/graph/', {'encoding': 'foo'}).status_code)
+
+    @override_settings(RESPONSE_COMPRESSION_MIN_SIZE=1)
+    def test_gzip(self):
+        self.client.post('/microdot/', self.data)
+        request = self.client.get('/graph/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual('gzip', request['Content-Encoding'])
+        content = json.loads(gzip.decompress(request.content).decode('utf-8'))
+        self.assertEqual(1, len(content['edges']))
+        etag = variant_etag(graph_cache.current_etag(), 'json')
+        self.assertTrue(etag_matches(etag, request['ETag'], 'gzip'))
+        self.assertIn('Accept-Encoding', request['Vary'])
+        self.assertNotIn('Content-Encoding', self.client.get('/graph/'))
+        request = self.client.get('/graph/', HTTP_IF_NONE_MATCH=request['ETag'])
+        self.assertEqual(200, request.status_code)
+
+
+class SamplingTestCase(GraphTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.sampler = AdaptiveSampler(threshold=1, window=10, rng=random.Random(0))
+        self.hit = ('origin', 'target', 'GET /test/1')
+
+    def test_sample_hot_triple(self):
+        with mock.patch('api.sampling.time') as clock:
+            clock.time.return_value = 1000
+            for _ in range(100):
+                self.assertEqual(({self.hit: 1}, 1.0), self.sampler.sample({self.hit: 1}))
+            clock.time.return_value = 1010
+            kept = Counter()
+            for _ in range(1000):
+                hits, rate = self.sampler.sample({self.hit: 1})
+                kept.update(hits)
+        self.assertEqual(0.1, rate)
+        self.assertTrue(800 < kept[self.hit] < 1200)
+        self.assertEqual(1.0, self.sampler.sample({('origin', 'other', 'GET /'): 1})[1])
+
+    def test_disabled(self):
+        hits = {self.hit: 1}
+        self.assertEqual((hits, 1.0), AdaptiveSampler(threshold=0).sample(hits))
+
+    @override_settings(MICRODOT_SAMPLING_THRESHOLD=1)
+    def test_sample_rate_header(self):
+        data = {'origin': 'origin', 'target': 'target', 'method': 'GET', 'endpoint': '/test/',
+                'weight': 3}
+        request = self.client.post('/microdot/', data)
+        self.assertEqual('1', request['X-Sample-Rate'])
+        endpoints = Edge(Vertex('origin'), Vertex('target')).load_endpoints()
+        self.assertEqual(3, endpoints['GET /test/'])
+
+
+class LatencySketchTestCase(TestCase):
+    def test_quantiles(self):
+        sketch = LatencySketch()
+        for duration in range(1, 1001):
+            sketch.add(duration)
+        self.assertAlmostEqual(500, sketch.quantile(0.5), delta=25)
+        self.assertAlmostEqual(990, sketch.quantile(0.99), delta=50)
+        self.assertIsNone(sketch.error_rate())
+
+    def test_high_quantiles_of_few_durations(self):
+        sketch = LatencySketch()
+        sketch.add(20)
+        sketch.add(40)
+        self.assertAlmostEqual(20, sketch.quantile(0.5), delta=2)
+        self.assertAlmostEqual(40, sketch.quantile(0.95), delta=4)
+        self.assertAlmostEqual(40, sketch.quantile(0.99), delta=4)
+
+    def test_merge_and_fields(self):
+        sketch = LatencySketch()
+        sketch.add(10, 200)
+        other = LatencySketch()
+        other.add(10 ** 9, 503, count=3)
+        sketch.merge(other)
+        self.assertEqual(0.75, sketch.error_rate())
+        self.assertEqual({sketches.bucket_index(10), sketches.BUCKETS}, set(sketch.buckets))
+        self.assertEqual(sketch, LatencySketch.from_fields(sketch.to_fields()))
+
+
+class LatencyApiTestCase(GraphTestCase):
+    def test_graph_latencies(self):
+        client = APIClient()
+        for duration, code in ((20, 200), (40, 500)):
+            client.post('/microdot/', {'origin': 'origin', 'target': 'target', 'method': 'GET',
+                                       'endpoint': '/test/', 'duration_ms': duration,
+                                       'status': code})
+        endpoint = client.get('/graph/').data['edges'][0]['endpoints'][0]
+        self.assertEqual(0.5, endpoint['error_rate'])
+        self.assertAlmostEqual(20, endpoint['p50'], delta=2)
+        self.assertAlmostEqual(40, endpoint['p99'], delta=4)
+
+
+class GraphCacheTestCase(GraphTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.data = {'origin': 'origin', 'target': 'target', 'method': 'GET', 'endpoint': '/test/'}
+        self.client.post('/microdot/', self.data)
+
+    def test_graph_has_etag(self):
+        request = self.client.get('/graph/')
+        self.assertEqual(variant_etag(graph_cache.current_etag(), 'json'), request['ETag'])
+        self.assertIn('Accept', request['Vary'].split(', '))
+
+    def test_not_modified(self):
+        etag = self.client.get('/graph/')['ETag']
+        request = self.client.get('/graph/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, request.status_code)
+
+    def test_etag_depends_on_representation(self):
+        etag = self.client.get('/graph/')['ETag']
+        request = self.client.get('/graph/', HTTP_IF_NONE_MATCH=etag,
+                                  HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(200, request.status_code)
+        self.assertNotEqual(etag, request['ETag'])
+        request = self.client.get('/graph/', {'encoding': 'dictionary'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, request.status_code)
+
+    def test_new_endpoint_changes_etag(self):
+        etag = self.client.get('/graph/')['ETag']
+        self.client.post('/microdot/', dict(self.data, endpoint='/other/'))
+        request = self.client.get('/graph/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, request.status_code)
+        self.assertNotEqual(etag, request['ETag'])
+
+    def test_repeated_hit_keeps_version(self):
+        version = self.backend.graph_version()
+        self.client.post('/microdot/', self.data)
+        self.assertEqual(version, self.backend.graph_version())
+
+
+class GraphChangesTestCase(GraphTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.data = {'origin': 'origin', 'target': 'target', 'method': 'GET', 'endpoint': '/test/'}
+        self.client.post('/microdot/', self.data)
+        self.version = self.client.get('/graph/changes/').data['version']
+
+    def get_changes(self):
+        return self.client.get('/graph/changes/', {'since': self.version}).data
+
+    def test_snapshot(self):
+        data = self.client.get('/graph/changes/').data
+        self.assertTrue(data['snapshot'])
+        self.assertEqual({'origin', 'target'}, {node['id'] for node in data['nodes']})
+        self.assertEqual(1, len(data['edges']))
+
+    def test_added(self):
+        self.client.post('/microdot/', dict(self.data, target='other'))
+        data = self.get_changes()
+        self.assertFalse(data['snapshot'])
+        self.assertEqual(['other'], [node['id'] for node in data['added']['nodes']])
+        self.assertEqual(['origin-other'], [edge['id'] for edge in data['added']['edges']])
+
+    def test_updated_counters(self):
+        self.client.post('/microdot/', self.data)
+        data = self.get_changes()
+        self.assertEqual([], data['added']['edges'])
+        self.assertEqual(2, data['updated']['edges'][0]['endpoints'][0]['access'])
+
+    def test_removed(self):
+        other = Vertex('other')
+        other.save()
+        Edge(other, Vertex('target')).save()
+        self.version = self.client.get('/graph/changes/').data['version']
+        Reaper().reap()
+        data = self.get_changes()
+        self.assertEqual([{'id': 'other-target', 'from': 'other', 'to': 'target'}],
+                         data['removed']['edges'])
+        self.assertEqual(['target'], [node['id'] for node in data['updated']['nodes']])
+
+    @skipIf(settings.COUNTER_BACKEND == 'redis' and settings.ENDPOINT_STORAGE_LAYOUT == 'keys',
+            'Keys of the keys layout expire on the Redis server, which a mocked clock '
+            "doesn't reach")
+    def test_expired_counters(self):
+        with mock.patch('api.backends.time') as clock:
+            clock.time.return_value = (time.time() + settings.ENDPOINT_ENTRY_TIMEOUT +
+                                       settings.ENDPOINT_BUCKET_SIZE)
+            data = self.get_changes()
+        self.assertEqual(['origin-target'], [edge['id'] for edge in data['removed']['edges']])
+
+    def test_old_version_gets_snapshot(self):
+        data = self.client.get('/graph/changes/', {'since': '0-0'}).data
+        self.assertTrue(data['snapshot'])
+
+    def test_invalid_version(self):
+        self.assertEqual(400, self.client.get('/graph/changes/', {'since': 'latest'}).status_code)
+
+    @override_settings(GRAPH_CHANGES_STREAM_TIMEOUT=0)
+    @mock.patch('api.views.cooperative', return_value=True)
+    def test_stream(self, cooperative):
+        self.client.post('/microdot/', dict(self.data, target='other'))
+        response = self.client.get('/graph/changes/stream/', HTTP_LAST_EVENT_ID=self.version)
+        self.assertEqual('text/event-stream', response['Content-Type'])
+        events = b''.join(response.streaming_content).decode('utf-8').split('\n\n')
+        self.assertTrue(events[1].startswith('id: '))
+        self.assertIn('event: changes', events[1])
+        self.assertIn('origin-other', events[1])
+
+    @mock.patch('api.views.cooperative', return_value=False)
+    def test_stream_needs_gevent(self, cooperative):
+        self.assertEqual(501, self.client.get('/graph/changes/stream/').status_code)
+
+
+class MicrodotListenerTestCase(GraphTestCase):
+    def setUp(self):
+        super().setUp()
+        self.listener = MicrodotListener(max_entries=2)
+
+    def test_parse_line(self):
+        self.assertEqual((('a', 'b', 'GET /users/{id}'), None), parse_line('a b GET /users/42'))
+        self.assertEqual((('a', 'b', 'POST /'), 12.5), parse_line('a b POST / 12.5'))
+        for line in ('a b GET', 'a b GET / slow', 'a b GET / -1', 'a b GET / 1 2'):
+            with self.assertRaises(ValueError):
+                parse_line(line)
+
+    def test_counters(self):
+        self.listener.feed(b'a b GET /\na b GET / 10\ninvalid\n\na c GET /\na d GET /\n')
+        self.assertEqual(Counter({'received': 3, 'parse_errors': 1, 'dropped': 1}),
+                         self.listener.counters)
+        hits, latencies = self.listener.take()
+        self.assertEqual(Counter({('a', 'b', 'GET /'): 2, ('a', 'c', 'GET /'): 1}), hits)
+        self.assertEqual(1, latencies['a', 'b', 'GET /'].count)
+
+    def test_stream_lines(self):
+        listener = MicrodotListener()
+        protocol = StreamProtocol(listener)
+        protocol.data_received(b'a b GET /\na b')
+        protocol.data_received(b' POST /\n' + b'x' * 5000)
+        protocol.data_received(b'x\na c GET /')
+        protocol.eof_received()
+        self.assertEqual(Counter({('a', 'b', 'GET /'): 1, ('a', 'b', 'POST /'): 1,
+                                  ('a', 'c', 'GET /'): 1}), listener.hits)
+        self.assertEqual(1, listener.counters['dropped'])
+
+    def test_flush(self):
+        self.listener.feed(b'origin target GET /test/ 20\n')
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.listener.flush(loop))
+        finally:
+            loop.close()
+        edge = APIClient().get('/graph/').data['edges'][0]
+        self.assertEqual(('origin', 'target'), (edge['from'], edge['to']))
+        self.assertEqual(1, edge['endpoints'][0]['access'])
+
+
+class MicrodotQueueTestCase(GraphTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.hit = ('origin', 'target', 'GET /test/')
+
+    def test_dequeue_and_ack(self):
+        self.backend.enqueue_microdots({self.hit: 2})
+        events = self.backend.dequeue_microdots('test', 10, 1)
+        self.assertEqual([('origin', 'target', 'GET /test/', 2)],
+                         [(e['origin'], e['target'], e['endpoint'], e['count']) for e in events])
+        self.backend.ack_microdots('test')
+        self.assertEqual(0, self.backend.recover_microdots('test'))
+
+    def test_recover_unacknowledged_events(self):
+        self.backend.enqueue_microdots({self.hit: 1})
+        self.backend.dequeue_microdots('test', 10, 1)
+        self.assertEqual(0, self.backend.queue_stats()['depth'])
+        self.assertEqual(1, self.backend.recover_microdots('test'))
+        self.assertEqual(1, self.backend.queue_stats()['depth'])
+
+    def test_dead_letter_failed_events(self):
+        self.backend.enqueue_microdots({self.hit: 1})
+        self.backend.dequeue_microdots('test', 10, 1)
+        self.assertEqual((1, 0), self.backend.retry_microdots('test', 2))
+        events = self.backend.dequeue_microdots('test', 10, 1)
+        self.assertEqual([1], [e['attempts'] for e in events])
+        self.assertEqual((0, 1), self.backend.retry_microdots('test', 2))
+        stats = self.backend.queue_stats()
+        self.assertEqual((0, 1), (stats['depth'], stats['dead_letter']))
+
+    def test_keep_events_of_live_workers(self):
+        self.backend.enqueue_microdots({self.hit: 1})
+        self.backend.dequeue_microdots('test', 10, 1)
+        self.assertEqual(0, self.backend.recover_abandoned_microdots())
+        self.assertEqual(1, self.backend.recover_microdots('test'))
+
+    @override_settings(MICRODOT_INGEST_MODE='queue')
+    def test_post_microdot_to_queue(self):
+        data = {'origin': 'origin', 'target': 'target', 'method': 'GET', 'endpoint': '/test/'}
+        request = self.client.post('/microdot/', data)
+        self.assertEqual(202, request.status_code)
+        stats = self.client.get('/microdot/queue/').data
+        self.assertEqual(1, stats['depth'])
 
 
 class RedisBackendTestCase(BaseEdgeTestCase):
@@ -203,9 +745,368 @@ class RedisBackendTestCase(BaseEdgeTestCase):
         endpoints = self.edge.load_endpoints()
         self.assertIn(test_endpoint, endpoints)
 
+    def test_load_endpoints_many(self):
+        Edge(self.origin, self.target, 'GET /test/').save()
+        other = Vertex('other')
+        other.save()
+        Edge(other, self.target, 'GET /test/2').save()
+        counters = self.backend.load_endpoints_many(['origin-target', 'other-target', 'none'])
+        self.assertEqual(Counter({'GET /test/': 1}), counters['origin-target'])
+        self.assertEqual(Counter({'GET /test/{id}': 1}), counters['other-target'])
+        self.assertEqual(Counter(), counters['none'])
+
     def test_load_multiple_endpoints(self):
         Edge(self.origin, self.target, 'GET /test/').save()
         self.edge = Edge(self.origin, self.target, 'GET /test/2')
         self.edge.save()
         endpoints = self.edge.load_endpoints()
         self.assertEqual(len(endpoints), 2)
+
+
+@skipUnless(settings.COUNTER_BACKEND == 'redis', 'Redis layouts need Redis')
+class EndpointStorageLayoutTestCase(GraphTestCase):
+    def test_layouts_load_the_same_counter(self):
+        for backend in (RedisBackend(), BucketedRedisBackend()):
+            backend.save_endpoints({('a-b', 'GET /'): 2, ('a-b', 'POST /'): 1})
+            backend.save_endpoint('a-b', 'GET /')
+            self.assertEqual(Counter({'GET /': 3, 'POST /': 1}), backend.load_endpoints('a-b'))
+            backend.flush_db()
+
+    def test_keys_layout_serves_graph(self):
+        client = APIClient()
+        with mock.patch.object(BaseGraph, 'backend', RedisBackend()):
+            for _ in range(2):
+                client.post('/microdot/', {'origin': 'origin', 'target': 'target',
+                                           'method': 'GET', 'endpoint': '/test/'})
+            self.assertEqual(Counter({'GET /test/': 2}),
+                             Edge(Vertex('origin'), Vertex('target')).load_endpoints())
+            edge = client.get('/graph/').data['edges'][0]
+        self.assertEqual(2, edge['endpoints'][0]['access'])
+
+    def test_buckets_do_not_leak_between_edges(self):
+        backend = BucketedRedisBackend()
+        backend.save_endpoint('a-b', 'GET /')
+        backend.save_endpoint('a-bc', 'GET /')
+        self.assertEqual(1, backend.load_endpoints('a-b')['GET /'])
+
+    def test_migration_reads_legacy_keys(self):
+        RedisBackend().save_endpoint('a-b', 'GET /')
+        backend = BucketedRedisBackend(legacy_reads=True)
+        backend.save_endpoint('a-b', 'GET /')
+        self.assertEqual(2, backend.load_endpoints('a-b')['GET /'])
+
+
+class AggregationBufferTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.flushed = []
+        self.buffer = AggregationBuffer(lambda *args: self.flushed.append(args), max_entries=2,
+                                        max_age=60, interval=60)
+
+    def tearDown(self):
+        super().tearDown()
+        self.buffer.stop()
+
+    def test_coalesce_hits(self):
+        self.buffer.add(('origin', 'target', 'GET /'))
+        self.buffer.add(('origin', 'target', 'GET /'))
+        self.buffer.flush()
+        self.assertEqual([(Counter({('origin', 'target', 'GET /'): 2}), {})], self.flushed)
+
+    def test_flush_when_full(self):
+        self.buffer.add(('origin', 'target', 'GET /'))
+        self.buffer.add(('origin', 'target', 'POST /'))
+        self.assertEqual(1, len(self.flushed))
+        self.assertFalse(self.buffer.hits)
+
+    def test_flush_on_stop(self):
+        self.buffer.add(('origin', 'target', 'GET /'))
+        self.buffer.stop()
+        self.assertEqual(1, len(self.flushed))
+
+    def test_flush_when_due(self):
+        self.buffer.max_age = 0
+        self.buffer.add(('origin', 'target', 'GET /'))
+        self.assertTrue(self.buffer.due())
+
+
+class LRUCacheTestCase(TestCase):
+    def test_evict_least_recently_used(self):
+        cache = LRUCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+
+    def test_expire_entries(self):
+        cache = LRUCache(2, 0)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+
+class EndpointNormalizerTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.normalizer = EndpointNormalizer({'users': ['/users/{name}/posts/{slug}']},
+                                             cache_size=16, max_endpoints=2)
+
+    def test_normalize_segments(self):
+        self.assertEqual('GET /day/{date}/{hash}/{id}', self.normalizer.normalize(
+            'GET /day/2016-07-01/0123456789abcdef0123/42?page=2'))
+
+    def test_keep_partially_numeric_segments(self):
+        self.assertEqual('GET /v2/2fa', self.normalizer.normalize('GET /v2/2fa'))
+
+    def test_service_template(self):
+        self.assertEqual('GET /users/{name}/posts/{slug}', self.normalizer.normalize(
+            'GET /users/john/posts/hello-world', 'users'))
+        self.assertEqual('GET /users/john/posts/hello-world', self.normalizer.normalize(
+            'GET /users/john/posts/hello-world', 'other'))
+
+    def test_memoize(self):
+        self.normalizer.normalize('GET /test/1')
+        self.normalizer.normalize('GET /test/1')
+        self.assertEqual(1, self.normalizer.normalize.cache_info().hits)
+
+    def test_fold_excess_endpoints(self):
+        known = {'GET /a', 'GET /b'}
+        self.assertEqual('GET /a', self.normalizer.fold('GET /a', known))
+        self.assertEqual('POST /{other}', self.normalizer.fold('POST /c', known))
+
+
+class MemoryBackendTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = MemoryBackend()
+
+    def test_count_endpoints(self):
+        self.backend.save_endpoints({('a-b', 'GET /'): 2})
+        self.backend.save_endpoint('a-b', 'POST /')
+        self.assertEqual(Counter({'GET /': 2, 'POST /': 1}), self.backend.load_endpoints('a-b'))
+
+    def test_graph_changes(self):
+        self.backend.bump_graph_version([['add', 'node', 'a']])
+        self.backend.bump_graph_version([['update', 'node', 'a']])
+        self.assertEqual((2, [['update', 'node', 'a']]), self.backend.load_graph_changes(1))
+        self.assertEqual((2, []), self.backend.load_graph_changes(2))
+        self.assertEqual((2, None), self.backend.load_graph_changes(3))
+        self.backend.changelog.pop()
+        self.assertEqual((2, None), self.backend.load_graph_changes(0))
+
+    @override_settings(GRAPH_CHANGELOG_SIZE=1)
+    def test_graph_changelog_size(self):
+        self.backend.bump_graph_version([['add', 'node', 'a']])
+        self.backend.bump_graph_version([['add', 'node', 'b']])
+        self.assertEqual((2, [['add', 'node', 'b']]), self.backend.load_graph_changes(1))
+        self.assertEqual((2, None), self.backend.load_graph_changes(0))
+
+    def test_expire_endpoints(self):
+        with mock.patch('api.backends.time') as clock:
+            clock.time.return_value = 1000
+            self.backend.save_endpoint('a-b', 'GET /')
+            clock.time.return_value += (settings.ENDPOINT_ENTRY_TIMEOUT +
+                                        settings.ENDPOINT_BUCKET_SIZE)
+            self.assertEqual(Counter(), self.backend.load_endpoints('a-b'))
+
+
+class MemoryGraphTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.graph = MemoryGraph()
+        self.origin = Node('Microdot', name='origin', endpoints=[])
+        self.target = Node('Microdot', name='target', endpoints=['GET /'])
+        self.relationship = Relationship(self.origin, 'Depends', self.target, name='origin-target')
+        self.graph.create(self.relationship)
+
+    def test_find_by_name(self):
+        self.assertIs(self.target, self.graph.find_one('Microdot', 'name', 'target'))
+        self.assertIsNone(self.graph.find_one('Microdot', 'name', 'other'))
+
+    def test_match(self):
+        self.assertEqual([self.relationship], self.graph.match(end_node=self.target))
+        self.assertIs(self.relationship, self.graph.match_one(self.origin, 'Depends', self.target))
+        self.assertIsNone(self.graph.match_one(self.target, 'Depends', self.origin))
+
+    def test_bulk_rows(self):
+        rows = {r['name']: r['dependents'] for r in self.graph.vertex_rows('Microdot', 'Depends')}
+        self.assertEqual({'origin': 0, 'target': 1}, rows)
+        edge = self.graph.edge_rows('Microdot', 'Depends')[0]
+        self.graph.delete_relationships('Depends', [edge['id']])
+        self.assertFalse(self.graph.exists(self.relationship))
+
+
+class BenchmarkTestCase(GraphTestCase):
+    def run_benchmark(self, services):
+        rng = random.Random(0)
+        calls = bench.synthetic_topology(services, 2, 2, rng)
+        return bench.run(bench.zipf_events(calls, 60, 1.1, rng), renders=2, batch_size=20)
+
+    def test_report(self):
+        report = self.run_benchmark(5)
+        self.assertEqual(3, report['ingest']['requests'])
+        self.assertEqual(2, report['graph']['requests'])
+        self.assertIsNotNone(report['graph']['latency_ms']['p99'])
+        self.assertIn('graph.edge_rows', report['graph']['backend_calls']['by_operation'])
+
+    def test_graph_backend_calls_do_not_grow_with_topology(self):
+        small = self.run_benchmark(4)['graph']['backend_calls']['total']
+        self.tearDown()
+        large = self.run_benchmark(40)['graph']['backend_calls']['total']
+        self.assertEqual(small, large)
+
+
+class RollupTestCase(BaseEdgeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        Edge(self.origin, self.target, 'GET /test/1').save()
+        Edge(self.origin, self.target, 'GET /test/2').save()
+
+    def test_load_rollups(self):
+        counters = self.backend.load_rollups_many(['origin-target'], 3600)
+        self.assertEqual(Counter({'GET /test/{id}': 2}), counters['origin-target'])
+
+    def test_rollup_tier(self):
+        self.assertEqual('minute', rollup_tier(600)[0])
+        self.assertEqual('minute', rollup_tier(3600)[0])
+        self.assertEqual('hour', rollup_tier(86400)[0])
+        self.assertEqual('day', rollup_tier(7 * 86400)[0])
+
+    def test_graph_window(self):
+        self.backend.flush_db()
+        self.assertFalse(self.client.get('/graph/').data['edges'])
+        Edge(self.origin, self.target, 'GET /test/1').save()
+        edges = self.client.get('/graph/', {'window': '24h'}).data['edges']
+        self.assertEqual(1, edges[0]['endpoints'][0]['access'])
+
+    def test_invalid_window(self):
+        self.assertEqual(400, self.client.get('/graph/', {'window': '1y'}).status_code)
+        self.assertEqual(400, self.client.get('/graph/', {'window': '30d'}).status_code)
+
+
+class GraphMetricsTestCase(TestCase):
+    def test_vertex_sizes(self):
+        min_size, max_size = settings.NODE_SIZE
+        self.assertEqual([min_size, (min_size + max_size) / 2, max_size],
+                         vertex_sizes([2, 3, 4], max_size).tolist())
+
+    def test_vertex_sizes_of_page(self):
+        sizes = vertex_sizes([2], settings.NODE_SIZE[1], minimum=0, maximum=4)
+        self.assertEqual([sum(settings.NODE_SIZE) / 2], sizes.tolist())
+
+    def test_endpoint_usages(self):
+        usages = endpoint_usages([['GET /a', 'GET /b'], []], [0, 0, 1],
+                                 [['GET /a'], ['GET /a', 'GET /b', 'GET /c'], ['GET /a']])
+        self.assertEqual([50.0, 100.0, 0.0], usages.tolist())
+
+    def test_no_endpoints(self):
+        self.assertEqual([], endpoint_usages([], [], []).tolist())
+        self.assertEqual([], vertex_sizes([], 0).tolist())
+
+
+class AdjacencyIndexTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        edges = [('web', 'api'), ('mobile', 'api'), ('api', 'auth'), ('jobs', 'auth'),
+                 ('billing', 'ledger'), ('ledger', 'billing')]
+        self.index = AdjacencyIndex.from_rows(
+            [{'name': 'auth'}], [{'origin': o, 'target': t} for o, t in edges])
+
+    def test_reachable(self):
+        self.assertEqual({'api': 1, 'jobs': 1, 'web': 2, 'mobile': 2}, self.index.reachable('auth'))
+        self.assertEqual({'auth': 1}, self.index.reachable('api', reverse=False))
+
+    def test_levels(self):
+        levels = dict(zip(self.index.names, self.index.levels().tolist()))
+        self.assertEqual({'web': 0, 'mobile': 0, 'jobs': 0, 'api': 1, 'auth': 2,
+                          'billing': -1, 'ledger': -1}, levels)
+        self.assertEqual(['web', 'api', 'auth'], self.index.longest_chain())
+
+    def test_cycles(self):
+        self.assertEqual([['billing', 'ledger']], self.index.cycles())
+
+    def test_dependents(self):
+        dependents = self.index.dependents()
+        self.assertEqual((2, 2, 0), (dependents['auth'], dependents['api'], dependents['web']))
+
+
+class AnalyticsApiTestCase(GraphTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        data = [{'origin': 'web', 'target': 'api', 'method': 'GET', 'endpoint': '/a'},
+                {'origin': 'api', 'target': 'auth', 'method': 'GET', 'endpoint': '/b'}]
+        self.client.post('/microdot/batch/', data, format='json')
+
+    def test_blast_radius(self):
+        content = self.client.get('/analytics/blast-radius/auth/').data
+        self.assertEqual([{'name': 'api', 'distance': 1}, {'name': 'web', 'distance': 2}],
+                         content['dependents'])
+        self.assertEqual(404, self.client.get('/analytics/blast-radius/unknown/').status_code)
+
+    def test_blast_radius_of_service_named_like_a_route(self):
+        data = [{'origin': 'web', 'target': 'socialgraph', 'method': 'GET', 'endpoint': '/a'},
+                {'origin': 'web', 'target': 'microdots', 'method': 'GET', 'endpoint': '/b'}]
+        self.client.post('/microdot/batch/', data, format='json')
+        for name in ('socialgraph', 'microdots'):
+            content = self.client.get('/analytics/blast-radius/{}/'.format(name)).data
+            self.assertEqual([{'name': 'web', 'distance': 1}], content['dependents'])
+
+    def test_depth_and_cycles(self):
+        self.assertEqual(['web', 'api', 'auth'],
+                         self.client.get('/analytics/depth/').data['longest_chain'])
+        self.assertEqual([], self.client.get('/analytics/cycles/').data['cycles'])
+
+
+class MetricsTestCase(GraphTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+
+    @override_settings(METRICS_RESPONSE_HEADER=True)
+    def test_backend_calls_header(self):
+        request = self.client.get('/graph/')
+        self.assertIn('graph=', request['X-Backend-Calls'])
+
+    def test_metrics_endpoint(self):
+        self.client.get('/graph/')
+        content = self.client.get('/metrics').content.decode('utf-8')
+        self.assertIn('# TYPE microdots_request_seconds histogram', content)
+        self.assertIn('view="GraphView"', content)
+
+    def test_proxy_records_calls(self):
+        registry = MetricsRegistry()
+        backend = InstrumentedProxy(MemoryBackend(), 'counters', registry)
+        with registry.track_calls() as calls:
+            backend.load_endpoints('a-b')
+            backend.load_endpoints('a-b')
+        self.assertEqual(Counter({'counters.load_endpoints': 2}), calls)
+        self.assertIn('microdots_backend_call_seconds_count{component="counters",'
+                      'operation="load_endpoints"} 2', registry.render())
+
+
+class ConcurrencyTestCase(TestCase):
+    def test_sequential_fallback(self):
+        self.assertEqual([1, 2], concurrently([lambda: 1, lambda: 2]))
+
+    def test_bind_counts_calls(self):
+        with metrics.track_calls() as calls:
+            thread = threading.Thread(
+                target=metrics.bind(lambda: metrics.record_call('graph', 'find_one', 0)))
+            thread.start()
+            thread.join()
+        self.assertEqual(1, calls['graph.find_one'])
+
+
+class ProcessLocalTestCase(TestCase):
+    def test_create_once_per_process(self):
+        factory = mock.Mock(side_effect=lambda: object())
+        local = ProcessLocal(factory)
+        self.assertFalse(factory.called)
+        first = local.get()
+        self.assertIs(first, local.get())
+        with mock.patch('api.connections.os.getpid', return_value=-1):
+            self.assertIsNot(first, local.get())
+        self.assertEqual(2, factory.call_count)
@@ -15,9 +15,23 @@ Including another URLconf
 from django.conf.urls import include, url
 from django.contrib import admin
 
-from .views import GraphView, MicrodotView
+from .views import (BlastRadiusView, CyclesView, DegreesView, DepthView, GraphChangesStreamView,
+                    GraphChangesView, GraphView, MetricsView, MicrodotBatchView,
+                    MicrodotQueueView, MicrodotView)
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
+    url(r'^microdot/batch/$', MicrodotBatchView.as_view(), name='microdot-batch'),
+    url(r'^microdot/queue/$', MicrodotQueueView.as_view(), name='microdot-queue'),
+    url(r'^graph/changes/stream/$', GraphChangesStreamView.as_view(),
+        name='graph-changes-stream'),
+    url(r'^graph/changes/$', GraphChangesView.as_view(), name='graph-changes'),
+    url(r'^graph/(?P<service>[^/]+)/$', GraphView.as_view(), name='graph-service'),
+    url(r'^metrics$', MetricsView.as_view(), name='metrics'),
+    url(r'^analytics/blast-radius/(?P<service>[^/]+)/$', BlastRadiusView.as_view(),
+        name='analytics-blast-radius'),
+    url(r'^analytics/depth/$', DepthView.as_view(), name='analytics-depth'),
+    url(r'^analytics/cycles/$', CyclesView.as_view(), name='analytics-cycles'),
+    url(r'^analytics/degrees/$', DegreesView.as_view(), name='analytics-degrees'),
     url(r'microdot/', MicrodotView.as_view(), name='microdot'),
     url(r'graph/', GraphView.as_view(), name='graph'),
 ]
@@ -1,51 +1,428 @@
+import base64
+import re
+import time
+
 from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 
-from .models import Edge, Vertex
-from .serializers import MicrodotSerializer, PortalSerializer
+from .analytics import analytics_index
+from .buffer import hit_buffer
+from .cache import etag_matches, graph_cache, variant_etag
+from .compression import choose_encoding
+from .changes import change_feed, parse_version
+from .concurrency import concurrently, cooperative
+from .instrumentation import InstrumentedViewMixin, metrics
+from .models import GraphReader, edge_usages, vertex_sizes
+from .sampling import sampler
+from .parsers import JSONLinesParser, MessagePackParser
+from .renderers import EventStreamRenderer, format_event
+from .serializers import MicrodotSerializer, PortalSerializer, encode_endpoints
+
+
+def defer_hits(hits, latencies=None):
+    """Hands ``hits`` and their ``latencies`` over to the buffer or the queue,
+    according to ``MICRODOT_INGEST_MODE``. Returns False if they must be
+    stored now."""
+    if settings.MICRODOT_INGEST_MODE == 'buffer':
+        hit_buffer.update(hits, latencies)
+        return True
+    if settings.MICRODOT_INGEST_MODE == 'queue':
+        settings.PERSISTENT_BACKEND.enqueue_microdots(hits, latencies)
+        return True
+    return False
+
+
+def sample_hits(hits):
+    """Samples ``hits`` when sampling is enabled, returning them with the
+    response headers telling clients the sample rate applied."""
+    if not sampler.enabled:
+        return hits, {}
+    hits, rate = sampler.sample(hits)
+    return hits, {'X-Sample-Rate': '{:.4g}'.format(rate)}
 
 
-class MicrodotView(APIView):
+class MicrodotView(InstrumentedViewMixin, APIView):
+    serializer_kwargs = {}
+
     def post(self, request):
-        serializer = MicrodotSerializer(data=request.data)
+        serializer = MicrodotSerializer(data=request.data, **self.serializer_kwargs)
         if serializer.is_valid(raise_exception=True):
-            serializer.save()
-            return Response('ok', status=status.HTTP_201_CREATED)
+            hits, headers = sample_hits(serializer.get_hits())
+            latencies = {hit: sketch for hit, sketch in serializer.get_latencies().items()
+                         if hit in hits}
+            if defer_hits(hits, latencies):
+                return Response('ok', status=status.HTTP_202_ACCEPTED, headers=headers)
+            serializer.save(hits, latencies)
+            return Response('ok', status=status.HTTP_201_CREATED, headers=headers)
+
 
+class MicrodotBatchView(MicrodotView):
+    parser_classes = (JSONParser, JSONLinesParser, MessagePackParser)
+    serializer_kwargs = {'many': True}
 
-class GraphView(APIView):
-    graph = settings.GRAPH
 
+class MicrodotQueueView(InstrumentedViewMixin, APIView):
     def get(self, request):
-        serializer = PortalSerializer({'nodes': self.get_vertices(),
-                                       'edges': self.get_edges()})
-        return Response(serializer.data, status=status.HTTP_200_OK)
-
-    def get_edges(self):
-        edges = []
-        for e in self.graph.match(rel_type=Edge.TYPE):
-            edge = Edge(origin=Vertex(e.start_node()['name']),
-                        target=Vertex(e.end_node()['name']))
-            if len(edge.load_endpoints()):
-                edges.append(edge)
+        return Response(settings.PERSISTENT_BACKEND.queue_stats(), status=status.HTTP_200_OK)
+
+
+WINDOW_UNITS = {'m': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_window(value):
+    """Parses a time window such as ``90m``, ``24h`` or ``7d`` into seconds."""
+    match = re.match(r'^(\d+)([mhd])$', value)
+    if not match:
+        raise ValidationError({'window': 'Expected a number of minutes, hours or days, '
+                                         'such as 1h, 24h or 7d.'})
+    seconds = int(match.group(1)) * WINDOW_UNITS[match.group(2)]
+    if not 0 < seconds <= settings.GRAPH_MAX_WINDOW:
+        raise ValidationError({'window': 'Must be at most {} seconds.'.format(
+            settings.GRAPH_MAX_WINDOW)})
+    return seconds
+
+
+def parse_number(field, value, cast=int, minimum=0, maximum=None):
+    try:
+        number = cast(value)
+    except ValueError:
+        number = None
+    if number is None or number < minimum or (maximum is not None and number > maximum):
+        if maximum is None:
+            bounds = 'at least {}'.format(minimum)
+        else:
+            bounds = 'between {} and {}'.format(minimum, maximum)
+        raise ValidationError({field: 'Must be a number {}.'.format(bounds)})
+    return number
+
+
+GRAPH_DIRECTIONS = ('in', 'out', 'both')
+
+
+def parse_direction(value):
+    if value not in GRAPH_DIRECTIONS:
+        raise ValidationError({'direction': 'Must be one of {}.'.format(
+            ', '.join(GRAPH_DIRECTIONS))})
+    return value
+
+
+GRAPH_FIELDS = ('id', 'label', 'value', 'endpoints', 'from', 'to', 'usage')
+
+
+def parse_fields(value):
+    """Parses a comma separated list of the node and edge fields to return."""
+    if not value:
+        return None
+    fields = set(value.split(','))
+    if not fields.issubset(GRAPH_FIELDS):
+        raise ValidationError({'fields': 'Must be a comma separated list of {}.'.format(
+            ', '.join(GRAPH_FIELDS))})
+    return fields
+
+
+GRAPH_ENCODINGS = ('dictionary',)
+
+
+def parse_encoding(value):
+    if value is not None and value not in GRAPH_ENCODINGS:
+        raise ValidationError({'encoding': 'Must be one of {}.'.format(
+            ', '.join(GRAPH_ENCODINGS))})
+    return value
+
+
+def parse_pattern(value):
+    if value is None:
+        return None
+    try:
+        re.compile(value)
+    except re.error:
+        raise ValidationError({'match': 'Must be a regular expression.'})
+    return value
+
+
+def encode_cursor(name):
+    return base64.urlsafe_b64encode(name.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    except (ValueError, UnicodeError):
+        raise ValidationError({'cursor': 'Invalid cursor.'})
+
+
+def parse_filters(params):
+    """Parses the name filters and the page of the vertices to load."""
+    filters = {'prefix': params.get('prefix'), 'pattern': parse_pattern(params.get('match'))}
+    if 'limit' in params or 'cursor' in params:
+        filters['limit'] = parse_number('limit', params.get('limit', settings.GRAPH_MAX_PAGE_SIZE),
+                                        minimum=1, maximum=settings.GRAPH_MAX_PAGE_SIZE)
+        filters['after'] = decode_cursor(params['cursor']) if 'cursor' in params else None
+    return filters
+
+
+def parse_since(value):
+    """Parses a version returned by ``GET /graph/changes/``, if any."""
+    if not value:
+        return None
+    since = parse_version(value)
+    if since is None:
+        raise ValidationError({'since': 'Must be a version returned by /graph/changes/.'})
+    return since
+
+
+class GraphView(InstrumentedViewMixin, APIView):
+    reader = GraphReader()
+    cache = graph_cache
+
+    def get(self, request, service=None):
+        params = request.query_params
+        window = params.get('window')
+        seconds = parse_window(window) if window else None
+        fields = parse_fields(params.get('fields'))
+        encoding = parse_encoding(params.get('encoding'))
+        min_access = parse_number('min_access', params.get('min_access', 0))
+        min_usage = parse_number('min_usage', params.get('min_usage', 0), float, maximum=100)
+        if service is None:
+            filters = parse_filters(params)
+        else:
+            depth = parse_number('depth', params.get('depth', 1), minimum=1,
+                                 maximum=settings.GRAPH_MAX_DEPTH)
+            direction = parse_direction(params.get('direction', 'both'))
+
+        snapshot = self.cache.current_etag()
+        representation = [request.accepted_renderer.format]
+        if encoding is not None:
+            representation.append(encoding)
+        etag = variant_etag(snapshot, *representation)
+        content_encoding, _ = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        headers = {'ETag': etag,
+                   'Vary': 'Accept, Accept-Encoding' if content_encoding else 'Accept'}
+        if etag_matches(etag, request.META.get('HTTP_IF_NONE_MATCH'), content_encoding):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        variant = (service,) + tuple(sorted(params.items()))
+        data = self.cache.get(snapshot, variant)
+        if data is None:
+            if service is None:
+                vertices, edges = self.get_graph(filters)
             else:
-                edge.delete()
-        return edges
-
-    def get_vertices(self):
-        vertices = []
-        max_depends = 0
-        min_depends = 0
-        for v in self.graph.find(label=Vertex.LABEL):
-            vertex = Vertex(name=v['name'])
-            dependents = vertex.dependents_number
-            max_depends = max(max_depends, dependents)
-            min_depends = min(min_depends, dependents)
-            vertices.append(vertex)
-
-        for v in vertices:
-            v.calc_vertex_size(min_depends, max_depends, len(vertices))
+                vertices, edges = self.get_subgraph(service, depth, direction)
+            serializer = PortalSerializer(
+                {'nodes': vertices, 'edges': self.get_edges(edges, seconds, min_access, min_usage)},
+                context={'fields': fields})
+            data = serializer.data
+            if service is None and 'limit' in filters:
+                data = dict(data, next=self.next_cursor(vertices, filters['limit']))
+            if encoding == 'dictionary':
+                data = encode_endpoints(data)
+            self.cache.set(snapshot, data, variant)
+        return Response(data, status=status.HTTP_200_OK, headers=headers)
+
+    def get_edges(self, edges, window=None, min_access=0, min_usage=0):
+        """Keeps the ``edges`` with at least ``min_access`` hits, and one, in
+        the live window, or in the last ``window`` seconds, and using at least
+        ``min_usage`` percent of the endpoints of their target."""
+        names = [edge.name for edge in edges]
+        backend = GraphReader.backend
+        if window:
+            counters = backend.load_rollups_many(names, window)
+            latencies = {}
+        else:
+            counters, latencies = concurrently([lambda: backend.load_endpoints_many(names),
+                                                lambda: backend.load_latencies_many(names)])
+
+        edges = [edge for edge in edges if len(counters[edge.name])]
+        for edge in edges:
+            edge.endpoint_counts = counters[edge.name]
+            edge.latencies = latencies.get(edge.name, {})
+
+        active = []
+        for edge, usage in zip(edges, edge_usages(edges).tolist()):
+            edge.usage = usage
+            if min_access and sum(edge.endpoint_counts.values()) < min_access:
+                continue
+            if min_usage and usage < min_usage:
+                continue
+            active.append(edge)
+        return active
 
+    def get_graph(self, filters):
+        """Loads the vertices and edges, and when paginating the statistics
+        of all the vertices, at once on gevent."""
+        calls = [lambda: self.reader.load_graph(**filters)]
+        if filters.get('limit') is not None:
+            calls.append(lambda: self.reader.vertex_stats(filters.get('prefix'),
+                                                          filters.get('pattern')))
+        (vertices, edges), *stats = concurrently(calls)
+        return self.size_vertices(vertices, stats[0] if stats else None), edges
+
+    def get_subgraph(self, service, depth, direction):
+        vertices, edges = self.reader.load_subgraph(service, depth, direction)
+        if not vertices:
+            raise NotFound('Unknown service: {}.'.format(service))
+        return self.size_vertices(vertices), edges
+
+    def size_vertices(self, vertices, stats=None):
+        """Sizes ``vertices`` by their dependents, relative to each other, or
+        to all the vertices described by ``stats`` for a page of them."""
+        nodes_number, minimum, maximum = len(vertices), None, None
+        if stats is not None:
+            nodes_number = stats['count']
+            minimum, maximum = stats['min_dependents'], stats['max_dependents']
+        sizes = vertex_sizes([v.dependents_number for v in vertices], nodes_number,
+                             minimum, maximum)
+        for vertex, size in zip(vertices, sizes.tolist()):
+            vertex.vertex_size = size
         return vertices
+
+    def next_cursor(self, vertices, limit):
+        if len(vertices) < limit:
+            return None
+        return encode_cursor(vertices[-1].name)
+
+
+class GraphChangesView(GraphView):
+    """Lists the nodes and edges of ``GET /graph/`` added, updated and removed
+    since the version ``since``, or the whole graph when ``since`` is missing
+    or too old, with the version to ask for next."""
+    feed = change_feed
+
+    def get(self, request):
+        since = parse_since(request.query_params.get('since'))
+        return Response(self.get_changes(since), status=status.HTTP_200_OK)
+
+    def get_changes(self, since=None):
+        changes = self.feed.load(since) if since is not None else None
+        if changes is None:
+            version = self.feed.current_version()
+            return dict(self.get_snapshot(), version=version, snapshot=True)
+
+        calls = [lambda: self.reader.load_named(changes.nodes, changes.edges)]
+        if changes.nodes:
+            calls.append(lambda: self.reader.vertex_stats())
+        (vertices, edges), *stats = concurrently(calls)
+        vertices = {v.name: v for v in self.size_vertices(vertices, stats[0] if stats else None)}
+        edges = {(e.node_from, e.node_to): e for e in self.get_edges(edges)}
+
+        data = {'version': changes.version, 'snapshot': False}
+        for kind, changed in (('added', True), ('updated', False)):
+            data[kind] = PortalSerializer({
+                'nodes': [vertices[name] for name in sorted(changes.nodes)
+                          if name in vertices and (name in changes.added_nodes) == changed],
+                'edges': [edges[pair] for pair in sorted(changes.edges)
+                          if pair in edges and (pair in changes.added_edges) == changed],
+            }).data
+        data['removed'] = {
+            'nodes': [name for name in sorted(changes.nodes) if name not in vertices],
+            'edges': [{'id': '{}-{}'.format(*pair), 'from': pair[0], 'to': pair[1]}
+                      for pair in sorted(changes.edges) if pair not in edges],
+        }
+        return data
+
+    def get_snapshot(self):
+        """Returns the graph of ``GET /graph/``, from its cache if possible."""
+        etag = self.cache.current_etag()
+        variant = (None,)
+        data = self.cache.get(etag, variant)
+        if data is None:
+            vertices, edges = self.get_graph({})
+            data = PortalSerializer({'nodes': vertices, 'edges': self.get_edges(edges)}).data
+            self.cache.set(etag, data, variant)
+        return data
+
+
+class GraphChangesStreamView(GraphChangesView):
+    """Streams the changes of ``GET /graph/changes/`` as Server-Sent Events,
+    starting from the ``Last-Event-ID`` of reconnecting clients.
+
+    Each stream holds its worker until it is closed, so streams are refused
+    unless the process runs on gevent, as in the ``gunicorn_gevent.py``
+    profile.
+    """
+    renderer_classes = (EventStreamRenderer, JSONRenderer)
+
+    def get(self, request):
+        if not cooperative():
+            return Response({'detail': 'Streams need the gevent workers of gunicorn_gevent.py.'},
+                            status=status.HTTP_501_NOT_IMPLEMENTED)
+        since = parse_since(request.META.get('HTTP_LAST_EVENT_ID') or
+                            request.query_params.get('since'))
+        response = StreamingHttpResponse(self.stream(since),
+                                         content_type=EventStreamRenderer.media_type)
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+    def stream(self, since):
+        """Yields a ``changes`` event whenever some are found, polling every
+        ``GRAPH_CHANGES_POLL_INTERVAL`` seconds, or just the new version, until
+        ``GRAPH_CHANGES_STREAM_TIMEOUT``."""
+        interval = settings.GRAPH_CHANGES_POLL_INTERVAL
+        deadline = time.time() + settings.GRAPH_CHANGES_STREAM_TIMEOUT
+        yield 'retry: {}\n\n'.format(int(interval * 1000))
+        while True:
+            data = self.get_changes(since)
+            changed = data['snapshot'] or any(
+                data[kind]['nodes'] or data[kind]['edges']
+                for kind in ('added', 'updated', 'removed'))
+            if changed:
+                yield format_event(JSONRenderer().render(data).decode('utf-8'),
+                                   id=data['version'], event='changes')
+            elif parse_version(data['version']) != since:
+                yield format_event(id=data['version'])
+            since = parse_version(data['version'])
+            if time.time() + interval >= deadline:
+                return
+            time.sleep(interval)
+
+
+class BlastRadiusView(InstrumentedViewMixin, APIView):
+    """Lists the services depending on ``service``, directly or not."""
+
+    def get(self, request, service):
+        index = analytics_index.get()
+        if service not in index.ids:
+            raise NotFound('Unknown service: {}.'.format(service))
+        distances = index.reachable(service)
+        dependents = [{'name': name, 'distance': distances[name]}
+                      for name in sorted(distances, key=lambda name: (distances[name], name))]
+        return Response({'service': service, 'dependents': dependents},
+                        status=status.HTTP_200_OK)
+
+
+class DepthView(InstrumentedViewMixin, APIView):
+    """Gives the length of the longest dependency chain leading to each
+    service, ``null`` for services in or depending on cycles."""
+
+    def get(self, request):
+        index = analytics_index.get()
+        levels = index.levels()
+        depths = [{'name': name, 'depth': level if level >= 0 else None}
+                  for name, level in zip(index.names, levels.tolist())]
+        return Response({'depths': depths, 'longest_chain': index.longest_chain(levels)},
+                        status=status.HTTP_200_OK)
+
+
+class CyclesView(InstrumentedViewMixin, APIView):
+    def get(self, request):
+        return Response({'cycles': analytics_index.get().cycles()}, status=status.HTTP_200_OK)
+
+
+class DegreesView(InstrumentedViewMixin, APIView):
+    def get(self, request):
+        index = analytics_index.get()
+        degrees = [{'name': name, 'in': dependents, 'out': dependencies}
+                   for name, dependents, dependencies in zip(
+                       index.names, index.in_degree().tolist(), index.out_degree().tolist())]
+        return Response({'nodes': degrees}, status=status.HTTP_200_OK)
+
+
+class MetricsView(APIView):
+    def get(self, request):
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
@@ -0,0 +1,24 @@
+"""gunicorn settings running the API on gevent workers:
+
+    $ gunicorn api.wsgi -c gunicorn_gevent.py
+
+Each worker serves up to GEVENT_WORKER_CONNECTIONS requests at once, switching
+to another request whenever one waits for Neo4j or Redis. The standard library
+is patched here, before the application is preloaded, so the locks and
+connection pools it creates are cooperative as well.
+"""
+import os
+
+from gevent import monkey
+monkey.patch_all()
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', 8000))
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('GEVENT_WORKER_CONNECTIONS', 100))
+preload_app = True
+errorlog = '-'
+
+# Concurrent requests share the Redis pool of their worker, so it must be
+# large enough for them not to wait on each other.
+os.environ.setdefault('REDIS_MAX_CONNECTIONS', str(worker_connections))